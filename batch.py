@@ -0,0 +1,24 @@
+"""
+Coalescing of several updates of one chat into a single load, render and save
+"""
+
+import contextvars
+
+
+class ChatBatch:
+    """
+    Shared by the handlers of all updates of one chat within a batched event
+    """
+
+    def __init__(self):
+        self.bot_data = None
+        # only the last reply of the batch is rendered
+        self.reply_text = None
+        self.reply_update = None
+        self.reply_context = None
+        # set by the error handler while the current update is processed
+        self.failed = False
+
+
+# the batch of the chat the current task is processing, None outside of batched events
+current_batch = contextvars.ContextVar("current_batch", default=None)
@@ -1,30 +1,193 @@
 """
 """
 
-import boto3
+from __future__ import annotations
+
 from botocore.exceptions import ClientError
+import asyncio
+import hashlib
 import logging
-
-from telegram import (
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-)
+import os
+from itertools import islice
+from typing import TYPE_CHECKING
 
 from telegram.error import BadRequest
 
-from telegram.ext import (
-    ContextTypes,
-)
+if TYPE_CHECKING:
+    from telegram.ext import ContextTypes
 
 from d20potz_state_machine import PotzState, PotzStateMachine
-from shared import setup_logging, throttle_telegram
+from keyboards import (
+    EMPTY_KEYBOARD,
+    HERO_STEP,
+    PAGE_SIZE,
+    ROLL_KEYBOARD,
+    ROOT_KEYBOARD,
+    build_deck_keyboard,
+    build_hand_keyboard,
+    build_hero_keyboard,
+    build_timer_keyboard,
+    get_page_bounds,
+)
+from potz.cards import find_card, get_deck_names, get_decks, send_cards
+from potz.dice import DiceError, rng, roll
+from potz.odds import format_expression_odds, format_pool_odds, format_pool_table
+from shared import setup_logging
+from statecache import ChatStateCache
+from outbound import OutboundQueue
+from potzdb import UpdateExpressionBuilder, get_potztable, is_conditional_check_failure
 from dataclasses import dataclass, field
+from enum import Enum
+from typing import Callable
+
+import callbacks
+from callbacks import decode_callback
 
 
 logger = setup_logging(logging.INFO, __name__)
-POTZ_TABLE = "potz_manager"
-dynamodb = boto3.resource('dynamodb')
-potztable = dynamodb.Table(POTZ_TABLE)
+
+# decoded chat state survives between invocations of a warm container
+STATE_CACHE_SIZE = 256
+STATE_CACHE_TTL = 300
+state_cache = ChatStateCache(STATE_CACHE_SIZE, STATE_CACHE_TTL)
+
+# list attributes whose entries are matched by name and whose counters are updated atomically
+COUNTER_FIELDS = {
+    'heroes': ('stress', 'harm'),
+    'timers': ('value',),
+}
+# attributes merged with the stored item on a conflict, so every rewrite of them is conditioned on the version
+MERGED_FIELDS = frozenset(COUNTER_FIELDS) | {'decks'}
+SAVE_RETRIES = 3
+# attributes older versions stored, removed from the item with its next write
+LEGACY_ATTRIBUTES = ('last_calls',)
+
+# dice are sent concurrently, but no more than this many requests to the chat are in flight at once
+MAX_CONCURRENT_DICE = 3
+MAX_ROLL_DICE = 6
+# heroes or timers a single command may add
+MAX_BATCH_ENTRIES = 20
+# send the roll summary as the reply carrying the keyboard instead of as an extra message
+ROLL_SUMMARY_AS_REPLY = os.getenv("POTZ_ROLL_SUMMARY_AS_REPLY", "0") == "1"
+
+
+class StateScope(Enum):
+    """
+    The stored attributes a handler needs, everything else is neither read nor written
+    """
+    none = frozenset()
+    full = frozenset({'state', 'page', 'inline_message_id', 'render_hash', 'heroes', 'timers', 'decks'})
+
+
+def decode_item(item: dict) -> dict:
+    """
+    Converts a stored item into the attribute format of BotData.get_item_attributes
+    """
+    attributes = {}
+    if 'state' in item:
+        attributes['state'] = item['state']
+    if 'page' in item:
+        attributes['page'] = int(item['page'])
+    if 'inline_message_id' in item:
+        inline_message_id = item['inline_message_id']
+        attributes['inline_message_id'] = None if inline_message_id is None else int(inline_message_id)
+    if 'render_hash' in item:
+        attributes['render_hash'] = item['render_hash']
+    if 'heroes' in item:
+        attributes['heroes'] = assign_ids([
+            {'id': decode_id(h), 'name': h['name'], 'stress': int(h['stress']), 'harm': int(h['harm'])}
+            for h in item['heroes']
+        ])
+    if 'timers' in item:
+        attributes['timers'] = assign_ids([
+            {'id': decode_id(t), 'name': t['name'], 'value': int(t['value'])} for t in item['timers']
+        ])
+    if 'decks' in item:
+        attributes['decks'] = {
+            name: {'hand': int(d['hand']), 'discard': int(d['discard'])} for name, d in item['decks'].items()
+        }
+    return attributes
+
+
+def decode_id(entry: dict):
+    return int(entry['id']) if 'id' in entry else None
+
+
+def assign_ids(entries: list) -> list:
+    """
+    Gives entries stored before ids existed the next free ids, in list order so every read agrees
+    """
+    next_id = max((e['id'] for e in entries if e['id'] is not None), default=0) + 1
+    for entry in entries:
+        if entry['id'] is None:
+            entry['id'] = next_id
+            next_id += 1
+    return entries
+
+
+def get_legacy_attributes(item: dict) -> tuple:
+    return tuple(name for name in LEGACY_ATTRIBUTES if name in item)
+
+
+def get_next_id(entries: dict) -> int:
+    return max(entries, default=0) + 1
+
+
+def merge_entries(base: list, ours: list, stored: list, counters: tuple) -> list:
+    """
+    Applies our additions, removals and counter deltas relative to base onto the stored entries
+    """
+    base_by_name = {e['name']: e for e in base}
+    ours_by_name = {e['name']: e for e in ours}
+
+    merged = []
+    for entry in stored:
+        name = entry['name']
+        if name in base_by_name and name not in ours_by_name:
+            # removed by us
+            continue
+        if name in base_by_name:
+            entry = dict(entry)
+            for counter in counters:
+                delta = ours_by_name[name][counter] - base_by_name[name][counter]
+                entry[counter] = max(0, entry[counter] + delta)
+        merged.append(entry)
+
+    stored_names = {e['name'] for e in stored}
+    for entry in ours:
+        if entry['name'] not in base_by_name and entry['name'] not in stored_names:
+            if any(e['id'] == entry['id'] for e in merged):
+                # somebody else added an entry with the same id in the meantime
+                entry = dict(entry, id=max(e['id'] for e in merged) + 1)
+            merged.append(entry)
+    return merged
+
+
+def get_render_hash(text: str, keyboard_fingerprint: tuple) -> str:
+    # the fingerprint determines the keyboard, so hashing it avoids serializing the markup
+    return hashlib.blake2b((text + repr(keyboard_fingerprint)).encode(), digest_size=8).hexdigest()
+
+
+def merge_decks(base: dict, ours: dict, stored: dict) -> dict:
+    """
+    Applies the cards we moved into or out of hand and discard relative to base onto the stored decks
+    """
+    empty = {'hand': 0, 'discard': 0}
+    merged = dict(stored)
+    for name in base.keys() | ours.keys():
+        before, after = base.get(name, empty), ours.get(name, empty)
+        if before == after:
+            continue
+        deck = dict(stored.get(name, empty))
+        for pile in ('hand', 'discard'):
+            added = after[pile] & ~before[pile]
+            removed = before[pile] & ~after[pile]
+            deck[pile] = (deck[pile] | added) & ~removed
+        if deck['hand'] or deck['discard']:
+            merged[name] = deck
+        else:
+            merged.pop(name, None)
+    return merged
 
 
 @dataclass
@@ -32,21 +195,76 @@ class PotzHero:
     name: str
     stress: int
     harm: int
+    id: int
 
-    def __init__(self, name: str, stress: int = 0, harm: int = 0):
+    def __init__(self, name: str, stress: int = 0, harm: int = 0, hero_id: int = 0):
         self.name = name
         self.stress = stress
         self.harm = harm
+        self.id = hero_id
 
 
 @dataclass
 class PotzTimer:
     name: str
     value: int
+    id: int
 
-    def __init__(self, name: str, value: int = 0):
+    def __init__(self, name: str, value: int = 0, timer_id: int = 0):
         self.name = name
         self.value = value
+        self.id = timer_id
+
+
+@dataclass
+class PotzDeck:
+    """
+    A chat's copy of an ability card deck, hand and discard are bitmasks over the card indexes
+    """
+    name: str
+    hand: int
+    discard: int
+
+    def __init__(self, name: str, hand: int = 0, discard: int = 0):
+        self.name = name
+        self.hand = hand
+        self.discard = discard
+
+    def get_cards(self) -> tuple[str, ...]:
+        return get_decks().get(self.name, ())
+
+    def get_draw_pile(self) -> int:
+        return ((1 << len(self.get_cards())) - 1) & ~(self.hand | self.discard)
+
+    def get_hand(self) -> list[int]:
+        return [i for i in range(len(self.get_cards())) if self.hand >> i & 1]
+
+    def draw(self):
+        """
+        Moves a random card from the draw pile to the hand, returns its index or None if the pile is empty
+        """
+        pile = self.get_draw_pile()
+        if not pile:
+            return None
+
+        skip = rng.randrange(pile.bit_count())
+        for _ in range(skip):
+            # clear the lowest set bit
+            pile &= pile - 1
+        card = (pile & -pile).bit_length() - 1
+        self.hand |= 1 << card
+        return card
+
+    def discard_card(self, card: int) -> bool:
+        if not self.hand >> card & 1:
+            return False
+        self.hand &= ~(1 << card)
+        self.discard |= 1 << card
+        return True
+
+    def shuffle(self):
+        # the discard pile goes back into the draw pile, the hand is kept
+        self.discard = 0
 
 
 @dataclass
@@ -56,15 +274,30 @@ class BotData:
     chat_id: int
     chat_type: str
     params : list[str] = field(default_factory=list)
-    last_calls: list[int] = field(default_factory=list)
 
     def __init__(self, update):
         self.inline_message_id = None
-        self.heroes = []
-        self.timers = []
-        self.last_calls = []
-        self.state_machine = None
-
+        # hash of the text and keyboard currently shown in the inline message
+        self.render_hash = None
+        # set when this update sent messages of its own, which the inline message should follow
+        self.sent_messages = False
+        # id -> hero/timer, in the order they were added
+        self.heroes = {}
+        self.timers = {}
+        self.decks = {}
+        self.state_machine = PotzStateMachine(PotzState.root)
+        self.scope = StateScope.none
+        self.saved_attributes = {}
+        self.legacy_attributes = ()
+        self.version = 0
+        # cosmetic requests, sent after the reply
+        self.outbound = OutboundQueue()
+        self.bind_update(update)
+
+    def bind_update(self, update):
+        """
+        Takes the sender and parameters of an update, batched updates of a chat share one BotData
+        """
         if not (message := update.message):
             message = update.edited_message
         if message:
@@ -78,140 +311,410 @@ class BotData:
 
         self.chat_id = update.effective_chat.id
         self.chat_type = update.effective_chat.type
-        self.load_state()
-
-    async def throttle(self) -> None:
-        # this coroutine modifies the list of last_calls and potentially awaits
-        await throttle_telegram(self.last_calls, self.chat_type)
 
     def set_default_state(self):
         self.state_machine = PotzStateMachine(PotzState.root)
 
-    def load_state(self):
+    def get_item_attributes(self) -> dict:
+        # the stored representation of the loaded attributes, used both for writing and for dirty tracking
+        scope = self.scope.value
+        attributes = {}
+        if 'state' in scope:
+            attributes['state'] = self.state_machine.get_state().name
+        if 'page' in scope:
+            attributes['page'] = self.state_machine.page
+        if 'inline_message_id' in scope:
+            attributes['inline_message_id'] = self.inline_message_id
+        if 'render_hash' in scope:
+            attributes['render_hash'] = self.render_hash
+        if 'heroes' in scope:
+            attributes['heroes'] = [
+                {'id': h.id, 'name': h.name, 'stress': h.stress, 'harm': h.harm} for h in self.heroes.values()
+            ]
+        if 'timers' in scope:
+            attributes['timers'] = [{'id': t.id, 'name': t.name, 'value': t.value} for t in self.timers.values()]
+        if 'decks' in scope:
+            attributes['decks'] = {
+                d.name: {'hand': d.hand, 'discard': d.discard} for d in self.decks.values() if d.hand or d.discard
+            }
+        return attributes
+
+    def get_changed_attributes(self) -> dict:
+        return {
+            name: value
+            for name, value in self.get_item_attributes().items()
+            if name not in self.saved_attributes or self.saved_attributes[name] != value
+        }
+
+    def load_state(self, scope: StateScope = StateScope.full):
+        self.scope = scope
+        if scope == StateScope.none:
+            return
+
         try:
-            response = potztable.get_item(Key={'chat_id': str(self.chat_id)})
+            cached = state_cache.get(self.chat_id)
+            if cached is not None:
+                version, attributes = cached
+                # a projected read of the version is enough to confirm the cached state is current
+                if self.get_stored_version() == version:
+                    self.apply_item_attributes(attributes)
+                    self.version = version
+                    self.saved_attributes = dict(attributes)
+                    return
+                state_cache.invalidate(self.chat_id)
+
+            response = get_potztable().get_item(Key={'chat_id': str(self.chat_id)})
             if not 'Item' in response:
+                # nothing is stored yet, the first save writes every attribute
                 self.set_default_state()
                 return
 
-            if 'state' in response['Item']:
-                state = PotzState[response['Item']['state']]
-                self.state_machine = PotzStateMachine(state)
-            else :
-                self.state_machine = PotzStateMachine(PotzState.root)
+            self.apply_stored_item(response['Item'])
 
-            if 'inline_message_id' in response['Item']:
-                self.inline_message_id = response['Item']['inline_message_id']
-                if not self.inline_message_id is None:
-                    self.inline_message_id = int(self.inline_message_id)
+        except (ClientError, ValueError):
+            logger.error("Error loading state", exc_info=True)
+            state_cache.invalidate(self.chat_id)
+            self.heroes = {}
+            self.timers = {}
+            self.set_default_state()
+            # the stored item is unknown, only overwrite what this update actually changes
+            self.saved_attributes = self.get_item_attributes()
+
+    def get_stored_version(self):
+        response = get_potztable().get_item(
+            Key={'chat_id': str(self.chat_id)},
+            ProjectionExpression='#v',
+            ExpressionAttributeNames={'#v': 'version'},
+        )
+        if not 'Item' in response:
+            return None
+        return int(response['Item'].get('version', 0))
 
-            if 'heroes' in response['Item']:
-                self.heroes = [PotzHero(h['name'], h['stress'], h['harm']) for h in response['Item']['heroes']]
+    def apply_item_attributes(self, attributes: dict):
+        if 'state' in attributes:
+            state = PotzState[attributes['state']]
+            self.state_machine = PotzStateMachine(state)
 
-            if 'timers' in response['Item']:
-                self.timers = [PotzTimer(t['name'], t['value']) for t in response['Item']['timers']]
+        if 'page' in attributes:
+            self.state_machine.page = attributes['page']
 
-            if 'last_calls' in response['Item']:
-                self.last_calls = [int(lc) for lc in response['Item']['last_calls']]
+        if 'inline_message_id' in attributes:
+            self.inline_message_id = attributes['inline_message_id']
 
-        except (ClientError, ValueError):
-            logger.error("Error loading state", exc_info=True)
-            self.set_default_state()
+        if 'render_hash' in attributes:
+            self.render_hash = attributes['render_hash']
 
-    def save2(self):
-        try:
-            potztable.put_item(Item={
-                'chat_id': str(self.chat_id),
-                'state': self.state_machine.get_state().name,
-                'inline_message_id': self.inline_message_id,
-                'heroes': [{'name': h.name, 'stress': h.stress, 'harm': h.harm} for h in self.heroes],
-                'last_calls': self.last_calls,
-                'timers': [{'name': t.name, 'value': t.value} for t in self.timers],
-            })
-        except ClientError:
-            logger.error("Error saving state", exc_info=True)
-
-    def add_hero(self, context: ContextTypes.DEFAULT_TYPE) -> str:
-        if len(self.params) < 2 or len(self.params) > 4:
-            return "Usage: /add_hero <hero> [stress] [harm]"
+        if 'heroes' in attributes:
+            self.heroes = {h['id']: PotzHero(h['name'], h['stress'], h['harm'], h['id']) for h in attributes['heroes']}
 
-        hero = self.params[1]
-        if '_' in hero:
-            return "Hero name cannot contain underscores"
+        if 'timers' in attributes:
+            self.timers = {t['id']: PotzTimer(t['name'], t['value'], t['id']) for t in attributes['timers']}
 
-        try:
-            stress = int(self.params[2]) if len(self.params) > 2 else 0
-            harm = int(self.params[3]) if len(self.params) > 3 else 0
-        except ValueError:
-            return "Stress and harm should be integers greater than or equal to 0"
+        if 'decks' in attributes:
+            self.decks = {name: PotzDeck(name, d['hand'], d['discard']) for name, d in attributes['decks'].items()}
 
-        if stress < 0 or harm < 0:
-            return "Stress and harm should be greater than or equal to 0"
+    def apply_stored_item(self, item: dict):
+        self.apply_item_attributes(decode_item(item))
+        self.version = int(item.get('version', 0))
+        self.saved_attributes = self.get_item_attributes()
+        self.legacy_attributes = get_legacy_attributes(item)
+        state_cache.put(self.chat_id, self.version, self.saved_attributes)
 
-        if hero in [h.name for h in self.heroes]:
-            return "Hero already exists"
+    def save2(self) -> bool:
+        """
+        Writes the changed attributes, returns False if they could not be saved
+        """
+        for _ in range(SAVE_RETRIES):
+            changes = self.get_changed_attributes()
+            if not changes:
+                return True
 
-        self.heroes.append(PotzHero(hero, stress, harm))
-        self.process("root", context)
+            try:
+                response = get_potztable().update_item(**self.build_update(changes))
+                self.apply_stored_item(response['Attributes'])
+                return True
+            except ClientError as e:
+                state_cache.invalidate(self.chat_id)
+                if not is_conditional_check_failure(e):
+                    logger.error("Error saving state", exc_info=True)
+                    return False
+
+            logger.warning("Concurrent update of chat %s, merging and retrying", self.chat_id)
+            try:
+                self.merge_stored_state()
+            except ClientError:
+                logger.error("Error reloading state for merge", exc_info=True)
+                return False
+
+        logger.error("Giving up saving chat %s after %s conflicting writes", self.chat_id, SAVE_RETRIES)
+        return False
+
+    def build_update(self, changes: dict) -> dict:
+        builder = UpdateExpressionBuilder()
+        structural = False
+        for name, value in changes.items():
+            if name in COUNTER_FIELDS and self.add_counter_updates(builder, name, value):
+                continue
+            builder.set(builder.name(name), value)
+            structural = structural or name in MERGED_FIELDS
+
+        for name in self.legacy_attributes:
+            builder.remove(builder.name(name))
+
+        version = builder.name('version')
+        builder.add(version, 1)
+        if structural:
+            # rewriting a whole list or the decks is only safe if nobody changed the item since we read it
+            if self.version:
+                builder.condition(f'{version} = {builder.value(self.version)}')
+            else:
+                builder.condition(f'attribute_not_exists({version})')
+
+        update = builder.build({'chat_id': str(self.chat_id)})
+        update['ReturnValues'] = 'ALL_NEW'
+        return update
+
+    def add_counter_updates(self, builder: UpdateExpressionBuilder, list_name: str, entries: list) -> bool:
+        """
+        Expresses changes of a hero/timer list as atomic increments if only counters changed.
+        Returns False if entries were added, removed or reordered.
+        """
+        saved = self.saved_attributes.get(list_name)
+        if saved is None or [e['name'] for e in saved] != [e['name'] for e in entries]:
+            return False
+
+        for index, (before, after) in enumerate(zip(saved, entries)):
+            entry_path = f"{builder.name(list_name)}[{index}]"
+            for counter in COUNTER_FIELDS[list_name]:
+                delta = after[counter] - before[counter]
+                if delta == 0:
+                    continue
+                path = f"{entry_path}.{builder.name(counter)}"
+                builder.increment(path, delta)
+                # the entry must still be at the same position, and must not drop below zero
+                builder.condition(f"{entry_path}.{builder.name('name')} = {builder.value(after['name'])}")
+                if delta < 0:
+                    builder.condition(f"{path} >= {builder.value(-delta)}")
+        return True
+
+    def merge_stored_state(self):
+        """
+        Three-way merge of our changes (against saved_attributes) into the freshly stored item
+        """
+        response = get_potztable().get_item(Key={'chat_id': str(self.chat_id)})
+        item = response.get('Item', {})
+        stored = decode_item(item)
+        ours = self.get_item_attributes()
+
+        merged = {name: value for name, value in stored.items() if name in self.scope.value}
+        for name, value in ours.items():
+            if name in COUNTER_FIELDS:
+                merged[name] = merge_entries(
+                    self.saved_attributes.get(name, []),
+                    value,
+                    stored.get(name, []),
+                    COUNTER_FIELDS[name],
+                )
+            elif name == 'decks':
+                merged[name] = merge_decks(self.saved_attributes.get(name, {}), value, stored.get(name, {}))
+            elif name not in self.saved_attributes or self.saved_attributes[name] != value:
+                merged[name] = value
+
+        self.apply_item_attributes(merged)
+        self.version = int(item.get('version', 0))
+        self.saved_attributes = {name: value for name, value in stored.items() if name in self.scope.value}
+        self.legacy_attributes = get_legacy_attributes(item)
+
+    def add_hero(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        """
+        /add_hero a 1 2 b c 3: every hero name may be followed by its stress and harm
+        """
+        usage = "Usage: /add_hero <hero> [stress] [harm] [<hero> [stress] [harm] ...]"
+        entries = []
+        for param in self.params[1:]:
+            if not param.lstrip("-").isdigit():
+                entries.append([param])
+            elif not entries or len(entries[-1]) == 3:
+                return usage
+            else:
+                entries[-1].append(int(param))
+
+        if not entries:
+            return usage
+        if len(entries) > MAX_BATCH_ENTRIES:
+            return f"At most {MAX_BATCH_ENTRIES} heroes can be added at once"
+        if any(value < 0 for entry in entries for value in entry[1:]):
+            return "Stress and harm should be greater than or equal to 0"
 
-        return f"Added hero {hero}"
+        added = []
+        existing = []
+        names = {h.name for h in self.heroes.values()}
+        for hero, stress, harm in (entry + [0] * (3 - len(entry)) for entry in entries):
+            if hero in names:
+                existing.append(hero)
+                continue
+            hero_id = get_next_id(self.heroes)
+            self.heroes[hero_id] = PotzHero(hero, stress, harm, hero_id)
+            names.add(hero)
+            added.append(hero)
+
+        if len(entries) == 1:
+            return f"Added hero {added[0]}" if added else "Hero already exists"
+        lines = []
+        if added:
+            lines.append(f"Added heroes {', '.join(added)}")
+        if existing:
+            lines.append(f"Already exist: {', '.join(existing)}")
+        return "\n".join(lines)
 
     def remove_hero(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
         if len(self.params) != 2:
             return "Usage: /remove_hero <hero>"
 
-        heroes_before = len(self.heroes)
         hero = self.params[1]
-        self.heroes = [h for h in self.heroes if h.name != hero]
-        if len(self.heroes) == heroes_before:
+        hero_id = next((h.id for h in self.heroes.values() if h.name == hero), None)
+        if hero_id is None:
             return f"Hero {hero} not found"
 
+        del self.heroes[hero_id]
+
         return f"Removed hero {hero}"
 
     def add_timer(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
-        if len(self.params) != 3:
-            return "Usage: /add_timer <timer> <start_value>"
+        """
+        /add_timer a 3 b 5: pairs of timer name and start value
+        """
+        params = self.params[1:]
+        if not params or len(params) % 2:
+            return "Usage: /add_timer <timer> <start_value> [<timer> <start_value> ...]"
+        if len(params) // 2 > MAX_BATCH_ENTRIES:
+            return f"At most {MAX_BATCH_ENTRIES} timers can be added at once"
+
+        entries = []
+        for timer, start_value in zip(params[::2], params[1::2]):
+            try:
+                start_value = int(start_value)
+            except ValueError:
+                return "Invalid start value, should be an integer"
+            if start_value <= 0:
+                return "Start value should be greater than 0"
+            entries.append((timer, start_value))
+
+        added = []
+        existing = []
+        names = {t.name for t in self.timers.values()}
+        for timer, start_value in entries:
+            if timer in names:
+                existing.append(timer)
+                continue
+            timer_id = get_next_id(self.timers)
+            self.timers[timer_id] = PotzTimer(timer, start_value, timer_id)
+            names.add(timer)
+            added.append(f"{timer} with start value {start_value}")
+
+        if len(entries) == 1:
+            return f"Added timer {added[0]}" if added else "Timer already exists"
+        lines = []
+        if added:
+            lines.append(f"Added timers {', '.join(added)}")
+        if existing:
+            lines.append(f"Already exist: {', '.join(existing)}")
+        return "\n".join(lines)
+
+    def roll_expression(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        if len(self.params) < 2:
+            return "Usage: /r <expression>, e.g. /r 2d20+5, /r 4d6kh3, /r 3d6!, /r 6d10>=8"
+
+        try:
+            return str(roll(" ".join(self.params[1:])))
+        except DiceError as e:
+            return str(e)
 
-        timer = self.params[1]
-        if '_' in timer:
-            return "Timer name cannot contain underscores"
+    def show_odds(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        if len(self.params) < 2:
+            return format_pool_table()
 
+        argument = " ".join(self.params[1:])
         try:
-            start_value = int(self.params[2])
-        except ValueError:
-            return "Invalid start value, should be an integer"
+            if argument.isdigit():
+                return "Odds (crit / success / partial / fail):\n" + format_pool_odds(int(argument))
+            return format_expression_odds(argument)
+        except DiceError as e:
+            return str(e)
+
+    async def show_cards(self, context: ContextTypes.DEFAULT_TYPE) -> str:
+        decks = get_decks()
+        if len(self.params) < 2 or len(self.params) > 3:
+            return f"Usage: /card <deck> [card], decks: {', '.join(decks)}"
 
-        if start_value <= 0:
-            return "Start value should be greater than 0"
+        deck = self.params[1]
+        if deck not in decks:
+            return f"Deck {deck} not found, decks: {', '.join(decks)}"
 
-        if timer in [t.name for t in self.timers]:
-            return "Timer already exists"
+        if len(self.params) == 2:
+            await send_cards(context.bot, self.chat_id, deck, list(decks[deck]))
+            return ""
 
-        self.timers.append(PotzTimer(timer, start_value))
+        card = find_card(deck, self.params[2])
+        if card is None:
+            return f"Card {self.params[2]} not found, {deck} cards: {', '.join(decks[deck])}"
 
-        return f"Added timer {timer} with start value {start_value}"
+        await send_cards(context.bot, self.chat_id, deck, [card])
+        return ""
 
-    async def set_inline_message_id(self, inline_message_id, context: ContextTypes.DEFAULT_TYPE):
+    def set_inline_message_id(self, inline_message_id, context: ContextTypes.DEFAULT_TYPE):
         if inline_message_id == self.inline_message_id:
             return
 
-        await self.cleanup_inline_message(context)
+        self.cleanup_inline_message(context)
         self.inline_message_id = inline_message_id
+        # the message gets a keyboard again, an earlier cleanup of it is obsolete
+        self.outbound.cancel(('keyboard', inline_message_id))
+
+    async def edit_inline_message(self, message_id: int, text: str, reply_markup, render_hash: str, context: ContextTypes.DEFAULT_TYPE) -> bool:
+        """
+        Shows text and keyboard in an existing message instead of sending a new one,
+        returns False if the message cannot be edited
+        """
+        if message_id == self.inline_message_id and render_hash == self.render_hash:
+            # nothing visible changed
+            return True
 
-    async def cleanup_inline_message(self, context: ContextTypes.DEFAULT_TYPE):
-        if self.inline_message_id is not None:
+        try:
+            await context.bot.edit_message_text(
+                chat_id=self.chat_id,
+                message_id=message_id,
+                text=text,
+                reply_markup=reply_markup,
+            )
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning("Cannot edit inline message %s: %s", message_id, e)
+                return False
+
+        self.set_inline_message_id(message_id, context)
+        self.render_hash = render_hash
+        return True
+
+    def cleanup_inline_message(self, context: ContextTypes.DEFAULT_TYPE):
+        """
+        Queues removing the keyboard of the inline message, sent with the next flush of self.outbound
+        """
+        if self.inline_message_id is None:
+            return
+
+        message_id = int(self.inline_message_id)
+        self.inline_message_id = None
+        self.render_hash = None
+
+        async def remove_keyboard():
             try:
-                message_id = self.inline_message_id
-                self.inline_message_id = None
-                await context.bot.edit_message_reply_markup(
-                    chat_id=str(self.chat_id),
-                    message_id=int(message_id),
-                )
+                await context.bot.edit_message_reply_markup(chat_id=self.chat_id, message_id=message_id)
             except BadRequest:
                 # this is fine, the message was already deleted
                 pass
-            except Exception:
-                logger.error("Failed to remove the previous inline keyboard", exc_info=True)
+
+        self.outbound.defer(('keyboard', message_id), remove_keyboard)
 
     def get_default_header(self):
         return f"D20 potz: {self.state_machine.get_state().name}"
@@ -223,152 +726,281 @@ class BotData:
             logger.error("Cannot transition from %s to %s", self.state_machine.get_state(), to_state)
         return self.get_default_header()
 
-    async def process_roll(self, dice_count: int, context: ContextTypes.DEFAULT_TYPE) -> str:
-        dice_results = []
-        for _ in range(dice_count):
-            message = await context.bot.send_dice(chat_id=self.chat_id)
-            dice_results.append(message.dice.value)
+    async def process_roll(self, context: ContextTypes.DEFAULT_TYPE, dice_count: int) -> str:
+        if not 1 <= dice_count <= MAX_ROLL_DICE:
+            return "Invalid dice count"
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_DICE)
+
+        async def send_die() -> int:
+            async with semaphore:
+                message = await context.bot.send_dice(chat_id=self.chat_id)
+            return message.dice.value
+
+        logger.info("Rolling %s dice", dice_count)
+        # gather keeps the results in the order the dice were requested
+        self.sent_messages = True
+        rolling = asyncio.gather(*(send_die() for _ in range(dice_count)))
+        # the keyboard moves below the dice, its old message is cleared while they roll
+        self.cleanup_inline_message(context)
+        await self.outbound.flush()
+        dice_results = await rolling
 
         dice_results_str = ", ".join(map(str, dice_results))
         text = f"Rolling {dice_count} {'die' if dice_count == 1 else 'dice'}... {dice_results_str}"
+        header = self.transition(PotzState.root)
+        if ROLL_SUMMARY_AS_REPLY:
+            return text
+
         await context.bot.send_message(
             chat_id=self.chat_id,
             text=text,
         )
 
-        return self.transition(PotzState.root)
+        return header
 
-    async def process_hero(self, callback: str, _context: ContextTypes.DEFAULT_TYPE) -> str:
-        callback_parts = callback.split("_")
-        if len(callback_parts) != 3:
-            if len(callback_parts) == 2:
-                return f"Press +/- to modify {callback_parts[1]}'s {callback_parts[0]}"
-            return "Invalid hero callback"
+    async def process_odds(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        return format_pool_table()
 
-        hero_name = callback_parts[2]
-        hero_field = callback_parts[0]
-        hero_op = callback_parts[1]
-
-        if hero_field not in ["stress", "harm"]:
-            return "Invalid hero field"
-
-        if hero_op not in ["plus", "minus"]:
-            return "Invalid operation"
-
-        hero = next((h for h in self.heroes if h.name == hero_name), None)
+    async def show_hero(self, _context: ContextTypes.DEFAULT_TYPE, hero_field: str, hero_id: int) -> str:
+        hero = self.heroes.get(hero_id)
         if hero is None:
             return "Hero not found"
+        return f"Press +/- to modify {hero.name}'s {hero_field}"
 
-        value = getattr(hero, hero_field)
-        if hero_op == "plus":
-            value += 1
-        else:
-            value -= 1
+    async def process_hero(self, _context: ContextTypes.DEFAULT_TYPE, hero_field: str, delta: int, hero_id: int) -> str:
+        hero = self.heroes.get(hero_id)
+        if hero is None:
+            return "Hero not found"
 
-        setattr(hero, hero_field, value)
+        setattr(hero, hero_field, max(0, getattr(hero, hero_field) + delta))
 
         return self.get_default_header()
 
-    async def process_timer(self, callback: str, _context: ContextTypes.DEFAULT_TYPE) -> str:
-        callback_parts = callback.split("_")
-        if len(callback_parts) != 3:
-            if len(callback_parts) == 2:
-                return f"Press - to decrease timer {callback_parts[1]}"
-            return "Invalid timer callback"
-
-        timer_name = callback_parts[2]
-        timer_op = callback_parts[1]
-
-        if timer_op not in ["minus", "remove"]:
-            return "Invalid operation"
+    async def show_timer(self, _context: ContextTypes.DEFAULT_TYPE, timer_id: int) -> str:
+        timer = self.timers.get(timer_id)
+        if timer is None:
+            return "Timer not found"
+        return f"Press - to decrease timer {timer.name}"
 
-        timer = next((t for t in self.timers if t.name == timer_name), None)
+    async def process_timer(self, _context: ContextTypes.DEFAULT_TYPE, timer_id: int) -> str:
+        timer = self.timers.get(timer_id)
         if timer is None:
             return "Timer not found"
 
-        if timer_op == "remove":
-            self.timers = [t for t in self.timers if t.name != timer_name]
-            return f"Removed timer {timer_name}"
+        if timer.value == 0:
+            return f"Timer {timer.name} already expired"
 
         timer.value -= 1
         if timer.value == 0:
-            return f"Timer {timer_name} expired"
+            return f"Timer {timer.name} expired"
+
+        return f"Timer {timer.name} decreased to {timer.value}"
+
+    def tick_timers(self) -> list[str]:
+        """
+        Decreases every running timer by one, returns the names of the timers that expired
+        """
+        expired = []
+        for timer in self.timers.values():
+            if timer.value > 0:
+                timer.value -= 1
+                if timer.value == 0:
+                    expired.append(timer.name)
+        return expired
+
+    async def tick_all_timers(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        if not any(t.value > 0 for t in self.timers.values()):
+            return "No running timers"
+        expired = self.tick_timers()
+        if expired:
+            return f"Timers ticked, expired: {', '.join(expired)}"
+        return "Timers ticked"
+
+    async def end_scene(self, _context: ContextTypes.DEFAULT_TYPE) -> str:
+        """
+        Ticks every timer, drops expired timers and clears the stress of every hero
+        """
+        self.tick_timers()
+        removed = [t.name for t in self.timers.values() if t.value == 0]
+        self.timers = {timer_id: t for timer_id, t in self.timers.items() if t.value > 0}
+        for hero in self.heroes.values():
+            hero.stress = 0
+
+        lines = ["Scene ended: stress cleared, timers ticked"]
+        if removed:
+            lines.append(f"Expired timers removed: {', '.join(removed)}")
+        return "\n".join(lines)
+
+    async def remove_timer(self, _context: ContextTypes.DEFAULT_TYPE, timer_id: int) -> str:
+        timer = self.timers.pop(timer_id, None)
+        if timer is None:
+            return "Timer not found"
+        return f"Removed timer {timer.name}"
+
+    async def set_page(self, _context: ContextTypes.DEFAULT_TYPE, page: int) -> str:
+        entries = self.timers if self.state_machine.get_state() == PotzState.timer else self.heroes
+        self.state_machine.page, _, _ = get_page_bounds(len(entries), page)
+        return self.get_default_header()
+
+    def get_deck(self, deck_index: int):
+        deck_names = get_deck_names()
+        if not 0 <= deck_index < len(deck_names):
+            return None
+        name = deck_names[deck_index]
+        if name not in self.decks:
+            self.decks[name] = PotzDeck(name)
+        return self.decks[name]
+
+    async def show_deck(self, _context: ContextTypes.DEFAULT_TYPE, deck_index: int) -> str:
+        deck = self.get_deck(deck_index)
+        if deck is None:
+            return "Deck not found"
+        return f"Draw a card from {deck.name} or shuffle its discard pile back"
+
+    async def draw_card(self, _context: ContextTypes.DEFAULT_TYPE, deck_index: int) -> str:
+        deck = self.get_deck(deck_index)
+        if deck is None:
+            return "Deck not found"
+
+        card = deck.draw()
+        if card is None:
+            return f"Deck {deck.name} is empty, shuffle the discard pile back first"
+        return f"Drew {deck.get_cards()[card]} from {deck.name}"
+
+    async def shuffle_deck(self, _context: ContextTypes.DEFAULT_TYPE, deck_index: int) -> str:
+        deck = self.get_deck(deck_index)
+        if deck is None:
+            return "Deck not found"
+
+        deck.shuffle()
+        return f"Shuffled the {deck.name} discard pile back into the deck"
+
+    async def show_hand(self, context: ContextTypes.DEFAULT_TYPE) -> str:
+        shown = False
+        for deck in self.decks.values():
+            cards = deck.get_cards()
+            hand = [cards[i] for i in deck.get_hand()]
+            if hand:
+                self.sent_messages = True
+                await send_cards(context.bot, self.chat_id, deck.name, hand)
+                shown = True
+        return self.get_default_header() if shown else "The hand is empty"
+
+    async def show_hand_card(self, context: ContextTypes.DEFAULT_TYPE, deck_index: int, card: int) -> str:
+        deck = self.get_deck(deck_index)
+        if deck is None:
+            return "Deck not found"
+        if card not in deck.get_hand():
+            return "Card is not in the hand"
+
+        self.sent_messages = True
+        await send_cards(context.bot, self.chat_id, deck.name, [deck.get_cards()[card]])
+        return self.get_default_header()
 
-        return f"Timer {timer_name} decreased to {timer.value}"
+    async def discard_hand_card(self, _context: ContextTypes.DEFAULT_TYPE, deck_index: int, card: int) -> str:
+        deck = self.get_deck(deck_index)
+        if deck is None:
+            return "Deck not found"
+        if not deck.discard_card(card):
+            return "Card is not in the hand"
+        return f"Discarded {deck.get_cards()[card]} from {deck.name}"
 
     async def process(self, callback: str, context: ContextTypes.DEFAULT_TYPE) -> str:
         try:
-            await self.cleanup_inline_message(context)
-
-            if callback in [item.value for item in PotzState]:
-                return self.transition(PotzState(callback))
+            opcode, args = decode_callback(callback)
+        except ValueError:
+            logger.warning("Malformed callback: %s", callback)
+            return self.get_default_header()
 
-            state = self.state_machine.get_state()
-            if state == PotzState.root:
-                pass
-            elif state in (PotzState.stress, PotzState.harm):
-                return await self.process_hero(callback, context)
-            elif state == PotzState.timer:
-                return await self.process_timer(callback, context)
-            elif state == PotzState.roll:
-                logger.info("Roll callback: %s", callback)
-                if not callback.startswith("roll"):
-                    pass
-                else:
-                    dice_count = int(callback[4])
-                    logger.info("Rolling %s dice", dice_count)
-                    return await self.process_roll(dice_count, context)
+        try:
+            state = STATES_BY_VALUE.get(opcode)
+            if state is not None and not args:
+                return self.transition(state)
+
+            handler = CALLBACK_HANDLERS.get(opcode)
+            if handler is None or len(args) != handler.arity:
+                logger.warning("Unknown callback: %s", callback)
+            elif self.state_machine.get_state() in handler.states:
+                return await handler.method(self, context, *handler.params, *args)
         except Exception:
             logger.error("Error processing callback", exc_info=True)
 
         return self.get_default_header()
 
-    def build_hero_keyboard(self, state: str):
-        keyboard = []
-        for hero in self.heroes:
-            line = []
-            value = getattr(hero, state)
-            line.append(InlineKeyboardButton(f"{hero.name}: {value}", callback_data=f"{state}_{hero.name}"))
-            line.append(InlineKeyboardButton("+", callback_data=f"{state}_plus_{hero.name}"))
-            if value > 0:
-                line.append(InlineKeyboardButton("-", callback_data=f"{state}_minus_{hero.name}"))
-            keyboard.append(line)
-        keyboard.append([InlineKeyboardButton("Back", callback_data=PotzState.root.name)])
-        return keyboard
-
-    def build_timer_keyboard(self):
-        keyboard = []
-        for timer in self.timers:
-            line = []
-            line.append(InlineKeyboardButton(f"{timer.name}", callback_data=f"timer_{timer.name}"))
-            if timer.value > 0:
-                line.append(InlineKeyboardButton(f"{timer.value} -> {timer.value - 1}", callback_data=f"timer_minus_{timer.name}"))
-            line.append(InlineKeyboardButton("Remove", callback_data=f"timer_remove_{timer.name}"))
-            keyboard.append(line)
-        keyboard.append([InlineKeyboardButton("Back", callback_data=PotzState.root.name)])
-        return keyboard
-
-    def get_inline_keyboard(self):
+    def render_keyboard(self) -> tuple:
+        """
+        Returns the inline keyboard of the current state and the fingerprint it was rendered from
+        """
         state = self.state_machine.get_state()
-        keyboard = []
 
         if state == PotzState.root:
-            keyboard = [
-                [InlineKeyboardButton("Roll", callback_data=PotzState.roll.name), InlineKeyboardButton("Timer", callback_data=PotzState.timer.name)],
-                [InlineKeyboardButton("Harm", callback_data=PotzState.harm.name), InlineKeyboardButton("Stress", callback_data=PotzState.stress.name)],
-            ]
-        elif state == PotzState.stress:
-            keyboard = self.build_hero_keyboard("stress")
-        elif state == PotzState.harm:
-            keyboard = self.build_hero_keyboard("harm")
-        elif state == PotzState.timer:
-            keyboard = self.build_timer_keyboard()
-        elif state == PotzState.roll:
-            keyboard = [
-                [InlineKeyboardButton("1d6", callback_data="roll1"), InlineKeyboardButton("2d6", callback_data="roll2"), InlineKeyboardButton("3d6", callback_data="roll3")],
-                [InlineKeyboardButton("4d6", callback_data="roll4"), InlineKeyboardButton("5d6", callback_data="roll5"), InlineKeyboardButton("6d6", callback_data="roll6")],
-                [InlineKeyboardButton("Back", callback_data=PotzState.root.name)],
-            ]
-
-        return InlineKeyboardMarkup(keyboard)
-
+            return ROOT_KEYBOARD, (state.name,)
+        if state == PotzState.roll:
+            return ROLL_KEYBOARD, (state.name,)
+        if state in (PotzState.stress, PotzState.harm):
+            page, pages, start = get_page_bounds(len(self.heroes), self.state_machine.page)
+            heroes = tuple(
+                (h.id, h.name, getattr(h, state.name)) for h in islice(self.heroes.values(), start, start + PAGE_SIZE)
+            )
+            return build_hero_keyboard(state.name, heroes, page, pages), (state.name, heroes, page, pages)
+        if state == PotzState.timer:
+            page, pages, start = get_page_bounds(len(self.timers), self.state_machine.page)
+            timers = tuple((t.id, t.name, t.value) for t in islice(self.timers.values(), start, start + PAGE_SIZE))
+            any_running = any(t.value > 0 for t in self.timers.values())
+            return build_timer_keyboard(timers, page, pages, any_running), (state.name, timers, page, pages, any_running)
+        if state == PotzState.deck:
+            decks = []
+            for index, (name, cards) in enumerate(get_decks().items()):
+                deck = self.decks.get(name) or PotzDeck(name)
+                decks.append((index, name, deck.hand.bit_count(), deck.get_draw_pile().bit_count(), len(cards), bool(deck.discard)))
+            decks = tuple(decks)
+            return build_deck_keyboard(decks), (state.name, decks)
+        if state == PotzState.hand:
+            deck_names = get_deck_names()
+            hand = tuple(
+                (deck_names.index(deck.name), deck.name, card, deck.get_cards()[card])
+                for deck in self.decks.values() if deck.name in deck_names
+                for card in deck.get_hand()
+            )
+            return build_hand_keyboard(hand), (state.name, hand)
+
+        return EMPTY_KEYBOARD, (state.name,)
+
+
+@dataclass(frozen=True)
+class CallbackHandler:
+    states: frozenset
+    method: Callable
+    params: tuple = ()
+    # number of numeric arguments encoded in the callback data
+    arity: int = 0
+
+
+STATES_BY_VALUE = {state.value: state for state in PotzState}
+
+# opcode -> handler, called as method(botData, context, *params, *arguments)
+CALLBACK_HANDLERS = {
+    callbacks.STRESS_SHOW: CallbackHandler(frozenset({PotzState.stress}), BotData.show_hero, ("stress",), 1),
+    callbacks.STRESS_PLUS: CallbackHandler(frozenset({PotzState.stress}), BotData.process_hero, ("stress", 1), 1),
+    callbacks.STRESS_MINUS: CallbackHandler(frozenset({PotzState.stress}), BotData.process_hero, ("stress", -1), 1),
+    callbacks.STRESS_STEP: CallbackHandler(frozenset({PotzState.stress}), BotData.process_hero, ("stress", HERO_STEP), 1),
+    callbacks.HARM_SHOW: CallbackHandler(frozenset({PotzState.harm}), BotData.show_hero, ("harm",), 1),
+    callbacks.HARM_PLUS: CallbackHandler(frozenset({PotzState.harm}), BotData.process_hero, ("harm", 1), 1),
+    callbacks.HARM_MINUS: CallbackHandler(frozenset({PotzState.harm}), BotData.process_hero, ("harm", -1), 1),
+    callbacks.HARM_STEP: CallbackHandler(frozenset({PotzState.harm}), BotData.process_hero, ("harm", HERO_STEP), 1),
+    callbacks.TIMER_SHOW: CallbackHandler(frozenset({PotzState.timer}), BotData.show_timer, (), 1),
+    callbacks.TIMER_MINUS: CallbackHandler(frozenset({PotzState.timer}), BotData.process_timer, (), 1),
+    callbacks.TIMER_REMOVE: CallbackHandler(frozenset({PotzState.timer}), BotData.remove_timer, (), 1),
+    callbacks.PAGE: CallbackHandler(frozenset({PotzState.stress, PotzState.harm, PotzState.timer}), BotData.set_page, (), 1),
+    callbacks.TIMER_TICK_ALL: CallbackHandler(frozenset({PotzState.timer}), BotData.tick_all_timers),
+    callbacks.END_SCENE: CallbackHandler(frozenset({PotzState.root}), BotData.end_scene),
+    callbacks.ROLL: CallbackHandler(frozenset({PotzState.roll}), BotData.process_roll, (), 1),
+    callbacks.ODDS: CallbackHandler(frozenset({PotzState.roll}), BotData.process_odds),
+    callbacks.DECK_SHOW: CallbackHandler(frozenset({PotzState.deck}), BotData.show_deck, (), 1),
+    callbacks.DECK_DRAW: CallbackHandler(frozenset({PotzState.deck}), BotData.draw_card, (), 1),
+    callbacks.DECK_SHUFFLE: CallbackHandler(frozenset({PotzState.deck}), BotData.shuffle_deck, (), 1),
+    callbacks.HAND_SHOW: CallbackHandler(frozenset({PotzState.hand}), BotData.show_hand),
+    callbacks.HAND_CARD: CallbackHandler(frozenset({PotzState.hand}), BotData.show_hand_card, (), 2),
+    callbacks.HAND_DISCARD: CallbackHandler(frozenset({PotzState.hand}), BotData.discard_hand_card, (), 2),
+}
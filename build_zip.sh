@@ -3,4 +3,5 @@
 output_file="d20potz.zip"
 
 rm -f $output_file
-zip -r $output_file . -x "*.git*" -x "*.sh" -x "*.md" -x "*.gitignore" -x "*.gitattributes" -x "*.gitmodules" -x "d20potz.cfg" -x "cards/*"
\ No newline at end of file
+# only the runtime modules and card images, boto3 and python-telegram-bot come from the lambda layer
+zip -r $output_file *.py potz shared cards -x "*__pycache__*" -x "*.git*" -x "*.md" -x "*.sh" -x "*.cfg"
@@ -0,0 +1,59 @@
+"""
+Compact callback_data codec for the inline keyboards.
+
+A callback is a short opcode followed by numeric arguments separated by dots, e.g. "s+3" is
+"stress plus for hero 3" and "c-2.7" is "discard card 7 of deck 2". State names are opcodes
+without arguments. Names never end up in callback_data, which keeps it far below
+telegram's 64 byte limit.
+"""
+
+ARGUMENT_CHARS = "0123456789."
+
+# heroes, by hero id
+STRESS_SHOW = "s"
+STRESS_PLUS = "s+"
+STRESS_MINUS = "s-"
+STRESS_STEP = "s++"
+HARM_SHOW = "h"
+HARM_PLUS = "h+"
+HARM_MINUS = "h-"
+HARM_STEP = "h++"
+
+# timers, by timer id
+TIMER_SHOW = "t"
+TIMER_MINUS = "t-"
+TIMER_REMOVE = "tx"
+TIMER_TICK_ALL = "t*"
+
+# macros, without arguments
+END_SCENE = "e"
+
+# paginated hero and timer screens, by page index
+PAGE = "p"
+
+# roll screen, by dice count
+ROLL = "r"
+ODDS = "o"
+
+# decks, by deck index and card index
+DECK_SHOW = "d"
+DECK_DRAW = "d+"
+DECK_SHUFFLE = "d~"
+HAND_CARD = "c"
+HAND_DISCARD = "c-"
+HAND_SHOW = "c*"
+
+
+def encode_callback(opcode: str, *args: int) -> str:
+    return opcode + ".".join(map(str, args))
+
+
+def decode_callback(data: str) -> tuple[str, tuple[int, ...]]:
+    """
+    Splits callback data into its opcode and arguments, raises ValueError for malformed arguments
+    """
+    opcode = data.rstrip(ARGUMENT_CHARS)
+    arguments = data[len(opcode):]
+    if not arguments:
+        return opcode, ()
+    return opcode, tuple(int(argument) for argument in arguments.split("."))
@@ -4,10 +4,7 @@ This module contains the state machine for the D20 Potz project.
 
 import logging
 from enum import Enum
-from shared import (
-    setup_logging,
-    StateMachine,
-)
+from shared import setup_logging
 
 logger = setup_logging(logging.INFO, __name__)
 
@@ -18,21 +15,51 @@ class PotzState(Enum):
     harm = "harm"
     timer = "timer"
     roll = "roll"
+    deck = "deck"
+    hand = "hand"
+
+
+# (from, to) pairs, new screens only need to be declared here
+TRANSITIONS = (
+    (PotzState.root, PotzState.stress),
+    (PotzState.root, PotzState.harm),
+    (PotzState.root, PotzState.timer),
+    (PotzState.root, PotzState.roll),
+    (PotzState.stress, PotzState.root),
+    (PotzState.harm, PotzState.root),
+    (PotzState.timer, PotzState.root),
+    (PotzState.roll, PotzState.root),
+    (PotzState.root, PotzState.deck),
+    (PotzState.deck, PotzState.root),
+    (PotzState.deck, PotzState.hand),
+    (PotzState.hand, PotzState.deck),
+)
+
 
+class PotzStateMachine:
+    """
+    The current state of a chat and the page shown on its screen,
+    the transition table is compiled once and shared by all instances
+    """
+    __slots__ = ('state', 'page')
 
-class PotzStateMachine(StateMachine):
-    def __init__(self, initial_state):
+    ALLOWED_TRANSITIONS = frozenset(TRANSITIONS)
+
+    def __init__(self, initial_state, page: int = 0):
         if initial_state not in PotzState:
             raise ValueError(f"Invalid initial state {initial_state}")
-        super().__init__(initial_state)
-        self.add_fixed_rules()
-
-    def add_fixed_rules(self):
-        self.add_rule(PotzState.root, PotzState.stress)
-        self.add_rule(PotzState.root, PotzState.harm)
-        self.add_rule(PotzState.root, PotzState.timer)
-        self.add_rule(PotzState.root, PotzState.roll)
-        self.add_rule(PotzState.stress, PotzState.root)
-        self.add_rule(PotzState.harm, PotzState.root)
-        self.add_rule(PotzState.timer, PotzState.root)
-        self.add_rule(PotzState.roll, PotzState.root)
+        self.state = initial_state
+        self.page = page
+
+    def get_state(self):
+        return self.state
+
+    def can_transition(self, to_state) -> bool:
+        return (self.state, to_state) in self.ALLOWED_TRANSITIONS
+
+    def transition(self, to_state):
+        if not self.can_transition(to_state):
+            raise ValueError(f"Cannot transition from {self.state} to {to_state}")
+        self.state = to_state
+        # every screen opens on its first page
+        self.page = 0
@@ -0,0 +1,98 @@
+"""
+Deduplication and rate limiting of error reports.
+
+Errors are fingerprinted by exception type and the innermost frames of their traceback that belong to
+this project, so errors raised deep in boto3 or httpx are told apart by where our code called them. The first
+reports of a fingerprint in every window are logged with the full payload, after that only every
+SAMPLE_EVERY-th occurrence gets a short line and the rest is counted, so a systemic failure
+cannot turn into a log storm.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+WINDOW = 60
+FULL_REPORTS_PER_WINDOW = 3
+SAMPLE_EVERY = 100
+# frames of the traceback that make up the fingerprint, from the innermost one of this project
+FINGERPRINT_FRAMES = 3
+MAX_FINGERPRINTS = 256
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+
+
+def is_project_file(filename: str) -> bool:
+    return filename.startswith(PROJECT_DIR) and "site-packages" not in filename
+
+
+def get_fingerprint(error: BaseException) -> str:
+    frames = []
+    tb = error.__traceback__
+    while tb is not None:
+        frames.append((tb.tb_frame.f_code.co_filename, tb.tb_frame.f_code.co_name, tb.tb_lineno))
+        tb = tb.tb_next
+    # errors raised entirely outside of the project keep the innermost frames
+    frames = [
+        (filename[len(PROJECT_DIR):], name, line) for filename, name, line in frames if is_project_file(filename)
+    ] or frames
+    key = f"{type(error).__module__}.{type(error).__qualname__}|{frames[-FINGERPRINT_FRAMES:]}"
+    return hashlib.blake2b(key.encode(), digest_size=6).hexdigest()
+
+
+class ErrorStats:
+    __slots__ = ("window_start", "in_window", "suppressed", "total")
+
+    def __init__(self, now: float):
+        self.window_start = now
+        self.in_window = 0
+        self.suppressed = 0
+        self.total = 0
+
+
+class ErrorReporter:
+    """
+    Decides per occurrence whether to log the full report, a sampled short line or nothing
+    """
+
+    FULL = "full"
+    SAMPLED = "sampled"
+    SUPPRESSED = "suppressed"
+
+    def __init__(self, window: float = WINDOW, full_reports: int = FULL_REPORTS_PER_WINDOW, sample_every: int = SAMPLE_EVERY):
+        self.window = window
+        self.full_reports = full_reports
+        self.sample_every = sample_every
+        self.stats = OrderedDict()
+
+    def record(self, fingerprint: str) -> tuple[str, ErrorStats, int]:
+        """
+        Returns the decision, the stats of the fingerprint and how many occurrences were suppressed
+        in the previous window, which the caller should report once
+        """
+        now = time.monotonic()
+        stats = self.stats.get(fingerprint)
+        if stats is None:
+            stats = self.stats[fingerprint] = ErrorStats(now)
+            while len(self.stats) > MAX_FINGERPRINTS:
+                self.stats.popitem(last=False)
+        self.stats.move_to_end(fingerprint)
+
+        previously_suppressed = 0
+        if now - stats.window_start >= self.window:
+            previously_suppressed = stats.suppressed
+            stats.window_start = now
+            stats.in_window = 0
+            stats.suppressed = 0
+
+        stats.in_window += 1
+        stats.total += 1
+        if stats.in_window <= self.full_reports:
+            return self.FULL, stats, previously_suppressed
+        if (stats.in_window - self.full_reports) % self.sample_every == 0:
+            return self.SAMPLED, stats, previously_suppressed
+        stats.suppressed += 1
+        return self.SUPPRESSED, stats, previously_suppressed
+
+
+error_reporter = ErrorReporter()
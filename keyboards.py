@@ -0,0 +1,168 @@
+"""
+Inline keyboards for the d20potz screens.
+
+Static screens are built once at import, dynamic ones are memoized by a fingerprint
+of what they show and reuse cached rows, so a re-render only builds the rows that changed.
+"""
+
+import logging
+from functools import lru_cache
+
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+)
+
+import callbacks
+from callbacks import encode_callback
+from d20potz_state_machine import PotzState
+from shared import setup_logging
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+KEYBOARD_CACHE_SIZE = 512
+ROW_CACHE_SIZE = 4096
+# heroes or timers per page, only the visible page is rendered and sent
+PAGE_SIZE = 8
+# counter change of the step buttons on the stress and harm screens
+HERO_STEP = 3
+
+BACK_ROW = (InlineKeyboardButton("Back", callback_data=PotzState.root.name),)
+
+ROOT_KEYBOARD = InlineKeyboardMarkup((
+    (InlineKeyboardButton("Roll", callback_data=PotzState.roll.name), InlineKeyboardButton("Timer", callback_data=PotzState.timer.name)),
+    (InlineKeyboardButton("Harm", callback_data=PotzState.harm.name), InlineKeyboardButton("Stress", callback_data=PotzState.stress.name)),
+    (InlineKeyboardButton("Decks", callback_data=PotzState.deck.name), InlineKeyboardButton("End scene", callback_data=callbacks.END_SCENE)),
+))
+
+ROLL_KEYBOARD = InlineKeyboardMarkup((
+    (InlineKeyboardButton("1d6", callback_data=encode_callback(callbacks.ROLL, 1)), InlineKeyboardButton("2d6", callback_data=encode_callback(callbacks.ROLL, 2)), InlineKeyboardButton("3d6", callback_data=encode_callback(callbacks.ROLL, 3))),
+    (InlineKeyboardButton("4d6", callback_data=encode_callback(callbacks.ROLL, 4)), InlineKeyboardButton("5d6", callback_data=encode_callback(callbacks.ROLL, 5)), InlineKeyboardButton("6d6", callback_data=encode_callback(callbacks.ROLL, 6))),
+    (InlineKeyboardButton("Odds", callback_data=callbacks.ODDS), InlineKeyboardButton("Back", callback_data=PotzState.root.name)),
+))
+
+EMPTY_KEYBOARD = InlineKeyboardMarkup(())
+
+
+# hero screen opcodes per counter: (show, plus, step, minus)
+HERO_OPCODES = {
+    "stress": (callbacks.STRESS_SHOW, callbacks.STRESS_PLUS, callbacks.STRESS_STEP, callbacks.STRESS_MINUS),
+    "harm": (callbacks.HARM_SHOW, callbacks.HARM_PLUS, callbacks.HARM_STEP, callbacks.HARM_MINUS),
+}
+HERO_STEP_LABEL = f"+{HERO_STEP}"
+
+TIMER_FOOTER_ROW = (
+    InlineKeyboardButton("Tick all", callback_data=callbacks.TIMER_TICK_ALL),
+    InlineKeyboardButton("Back", callback_data=PotzState.root.name),
+)
+
+
+def get_page_bounds(count: int, page: int) -> tuple[int, int, int]:
+    """
+    (page clamped to the existing pages, page count, index of the first entry on the page)
+    """
+    pages = max(1, -(-count // PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    return page, pages, page * PAGE_SIZE
+
+
+@lru_cache(maxsize=ROW_CACHE_SIZE)
+def build_page_row(page: int, pages: int) -> tuple:
+    line = []
+    if page > 0:
+        line.append(InlineKeyboardButton("<", callback_data=encode_callback(callbacks.PAGE, page - 1)))
+    line.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=encode_callback(callbacks.PAGE, page)))
+    if page < pages - 1:
+        line.append(InlineKeyboardButton(">", callback_data=encode_callback(callbacks.PAGE, page + 1)))
+    return tuple(line)
+
+
+def get_page_rows(page: int, pages: int) -> tuple:
+    return (build_page_row(page, pages),) if pages > 1 else ()
+
+
+@lru_cache(maxsize=ROW_CACHE_SIZE)
+def build_hero_row(state: str, hero_id: int, name: str, value: int) -> tuple:
+    show, plus, step, minus = HERO_OPCODES[state]
+    line = [
+        InlineKeyboardButton(f"{name}: {value}", callback_data=encode_callback(show, hero_id)),
+        InlineKeyboardButton("+", callback_data=encode_callback(plus, hero_id)),
+        InlineKeyboardButton(HERO_STEP_LABEL, callback_data=encode_callback(step, hero_id)),
+    ]
+    if value > 0:
+        line.append(InlineKeyboardButton("-", callback_data=encode_callback(minus, hero_id)))
+    return tuple(line)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def build_hero_keyboard(state: str, heroes: tuple, page: int = 0, pages: int = 1) -> InlineKeyboardMarkup:
+    """
+    heroes: ((id, name, value of the state's counter), ...) of the visible page
+    """
+    return InlineKeyboardMarkup((
+        *(build_hero_row(state, *hero) for hero in heroes),
+        *get_page_rows(page, pages),
+        BACK_ROW,
+    ))
+
+
+@lru_cache(maxsize=ROW_CACHE_SIZE)
+def build_timer_row(timer_id: int, name: str, value: int) -> tuple:
+    line = [InlineKeyboardButton(f"{name}", callback_data=encode_callback(callbacks.TIMER_SHOW, timer_id))]
+    if value > 0:
+        line.append(InlineKeyboardButton(f"{value} -> {value - 1}", callback_data=encode_callback(callbacks.TIMER_MINUS, timer_id)))
+    line.append(InlineKeyboardButton("Remove", callback_data=encode_callback(callbacks.TIMER_REMOVE, timer_id)))
+    return tuple(line)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def build_timer_keyboard(timers: tuple, page: int = 0, pages: int = 1, any_running: bool = False) -> InlineKeyboardMarkup:
+    """
+    timers: ((id, name, value), ...) of the visible page, any_running: whether any timer on any page is running
+    """
+    return InlineKeyboardMarkup((
+        *(build_timer_row(*timer) for timer in timers),
+        *get_page_rows(page, pages),
+        TIMER_FOOTER_ROW if any_running else BACK_ROW,
+    ))
+
+
+@lru_cache(maxsize=ROW_CACHE_SIZE)
+def build_deck_row(index: int, name: str, in_hand: int, left: int, size: int, has_discard: bool) -> tuple:
+    line = [InlineKeyboardButton(f"{name}: {in_hand} in hand, {left}/{size} left", callback_data=encode_callback(callbacks.DECK_SHOW, index))]
+    if left > 0:
+        line.append(InlineKeyboardButton("Draw", callback_data=encode_callback(callbacks.DECK_DRAW, index)))
+    if has_discard:
+        line.append(InlineKeyboardButton("Shuffle", callback_data=encode_callback(callbacks.DECK_SHUFFLE, index)))
+    return tuple(line)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def build_deck_keyboard(decks: tuple) -> InlineKeyboardMarkup:
+    """
+    decks: ((index, name, cards in hand, cards left, deck size, has discard), ...)
+    """
+    return InlineKeyboardMarkup((
+        *(build_deck_row(*deck) for deck in decks),
+        (InlineKeyboardButton("Hand", callback_data=PotzState.hand.name), InlineKeyboardButton("Back", callback_data=PotzState.root.name)),
+    ))
+
+
+@lru_cache(maxsize=ROW_CACHE_SIZE)
+def build_hand_row(deck_index: int, deck: str, card: int, card_name: str) -> tuple:
+    return (
+        InlineKeyboardButton(f"{deck}: {card_name}", callback_data=encode_callback(callbacks.HAND_CARD, deck_index, card)),
+        InlineKeyboardButton("Discard", callback_data=encode_callback(callbacks.HAND_DISCARD, deck_index, card)),
+    )
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def build_hand_keyboard(hand: tuple) -> InlineKeyboardMarkup:
+    """
+    hand: ((deck index, deck, card index, card name), ...)
+    """
+    return InlineKeyboardMarkup((
+        *(build_hand_row(*card) for card in hand),
+        (InlineKeyboardButton("Show hand", callback_data=callbacks.HAND_SHOW), InlineKeyboardButton("Back", callback_data=PotzState.deck.name)),
+    ))
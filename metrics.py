@@ -0,0 +1,127 @@
+"""
+Per update latency spans and counters, written as CloudWatch embedded metric format (EMF) log lines.
+
+    with update_metrics("roll"):
+        with span("load_state"):
+            ...
+        count("telegram_calls")
+
+Spans and counters outside of update_metrics, or while metrics are disabled, cost one context variable
+lookup. Metrics are switched with the POTZ_METRICS environment variable or set_enabled at runtime.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import time
+
+NAMESPACE = "d20potz"
+DIMENSIONS = ("Handler", "State", "Start")
+
+enabled = os.getenv("POTZ_METRICS", "1") == "1"
+# the first update of the process pays for imports and connections
+cold_start = True
+
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+
+NULL_SPAN = contextlib.nullcontext()
+
+
+class UpdateMetrics:
+    def __init__(self, handler: str, start: str):
+        self.dimensions = {"Handler": handler, "State": "none", "Start": start}
+        # name -> (unit, value)
+        self.values = {}
+
+    def add(self, name: str, unit: str, value: float):
+        _, total = self.values.get(name, (unit, 0))
+        self.values[name] = (unit, total + value)
+
+    def to_emf(self) -> dict:
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [list(DIMENSIONS)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (unit, _) in self.values.items()],
+                }],
+            },
+            **self.dimensions,
+            **{name: round(value, 3) for name, (_, value) in self.values.items()},
+        }
+
+
+class Span:
+    __slots__ = ("metrics", "name", "started_at")
+
+    def __init__(self, metrics: UpdateMetrics, name: str):
+        self.metrics = metrics
+        self.name = name
+        self.started_at = 0.0
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *_exc):
+        # concurrent spans of the same stage, like the dice of a roll, add up
+        self.metrics.add(self.name, "Milliseconds", (time.perf_counter() - self.started_at) * 1000)
+        return False
+
+
+def set_enabled(value: bool):
+    global enabled # pylint: disable=global-statement
+    enabled = value
+
+
+def is_active() -> bool:
+    return current_metrics.get() is not None
+
+
+def span(name: str):
+    metrics = current_metrics.get()
+    if metrics is None:
+        return NULL_SPAN
+    return Span(metrics, name)
+
+
+def count(name: str, value: int = 1, unit: str = "Count"):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.add(name, unit, value)
+
+
+def set_dimension(name: str, value: str):
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.dimensions[name] = value
+
+
+@contextlib.contextmanager
+def update_metrics(handler: str):
+    """
+    Collects the metrics of one update and writes them when it is done
+    """
+    global cold_start # pylint: disable=global-statement
+    if not enabled:
+        yield
+        return
+
+    metrics = UpdateMetrics(handler, "cold" if cold_start else "warm")
+    cold_start = False
+    token = current_metrics.set(metrics)
+    try:
+        with Span(metrics, "update"):
+            yield
+    finally:
+        current_metrics.reset(token)
+        # EMF has to be the whole log line, so it bypasses the logging formatter
+        sys.stdout.write(json.dumps(metrics.to_emf()) + "\n")
+        sys.stdout.flush()
+
+
+def get_payload_size(payload) -> int:
+    return len(json.dumps(payload, default=str))
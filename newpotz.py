@@ -1,7 +1,9 @@
 import asyncio
+import atexit
 import json
 import logging
 import os
+import signal
 import traceback
 
 from telegram import (
@@ -17,78 +19,435 @@ from telegram.ext import (
     CallbackQueryHandler,
 )
 
-from botdata import BotData
+from telegram.request import HTTPXRequest
+
+import metrics
+from batch import ChatBatch, current_batch
+from botdata import BotData, StateScope, get_render_hash
+from errorreport import ErrorReporter, error_reporter, get_fingerprint
+from ratelimit import PotzRateLimiter
 from utils import get_client_help_message
 from shared import setup_logging, PotzRateLimitException
 
 logger = setup_logging(logging.INFO, __name__)
 
-app = ApplicationBuilder().token(os.getenv("TELEGRAM_TOKEN")).build()
-is_initialized = False
+# keep one event loop and one initialized application (with its keep-alive connections to telegram)
+# for the lifetime of the container instead of setting them up for every event
+PERSISTENT_APP = os.getenv("POTZ_PERSISTENT_APP", "1") == "1"
+CONNECTION_POOL_SIZE = 8
+# commands that get their own Handler dimension in the metrics
+METRIC_COMMANDS = frozenset({
+    "help", "start", "roll", "r", "odds", "card", "add_hero", "remove_hero", "add_timer", "privacy",
+})
+# chats of a batched event that are processed at the same time
+MAX_CONCURRENT_CHATS = 8
+
+# built on first use, so importing this module stays cheap
+app = None
+is_app_initialized = False
+event_loop = None
+# warm chat state of the standalone server, see server.py
+chat_sessions = None
+
+
+async def tg_bot_main(application, body):
+    async with application:
+        await process_update(application, body)
+
+
+async def tg_bot_main_persistent(application, body):
+    await initialize_app(application)
+    await process_update(application, body)
+
+
+async def process_update(application, body):
+    with metrics.update_metrics("unknown"):
+        with metrics.span("parse"):
+            update = Update.de_json(body, application.bot)
+        metrics.set_dimension("Handler", get_handler_label(update))
+        await application.process_update(update)
+
+
+def get_handler_label(update) -> str:
+    """
+    The command or "callback", used to tell the metrics of the handlers apart
+    """
+    if not isinstance(update, Update):
+        return "unknown"
+    if update.callback_query:
+        return "callback"
+    message = update.effective_message
+    if message and message.text and message.text.startswith("/"):
+        command = message.text.split()[0][1:].split("@")[0]
+        # anything users type must not become a metric dimension
+        if command in METRIC_COMMANDS:
+            return command
+    return "other"
 
 
-async def tg_bot_main(application, event):
+async def tg_bot_batch(application, records):
     async with application:
-        await application.process_update(
-            Update.de_json(json.loads(event["body"]), application.bot)
-        )
+        return await process_batch(application, records)
+
+
+async def tg_bot_batch_persistent(application, records):
+    await initialize_app(application)
+    return await process_batch(application, records)
+
+
+async def initialize_app(application):
+    global is_app_initialized # pylint: disable=global-statement
+    if not is_app_initialized:
+        await application.initialize()
+        is_app_initialized = True
+
+
+def get_batch_records(event, body):
+    """
+    (record id, update) pairs of an SQS batch or of a json array body, None for a single update
+    """
+    if "Records" in event:
+        records = []
+        for record in event["Records"]:
+            try:
+                body = json.loads(record["body"])
+            except (KeyError, TypeError, ValueError):
+                # processed as a record without an update, which fails on its own
+                logger.error("Undecodable record %s", record["messageId"], exc_info=True)
+                body = None
+            records.append((record["messageId"], body))
+        return records
+    if isinstance(body, list):
+        return [(str(i), update) for i, update in enumerate(body)]
+    return None
+
+
+async def process_batch(application, records) -> list:
+    """
+    Applies the updates of every chat in order, chats run concurrently. Returns the failed record ids.
+    """
+    chats = {}
+    failed = []
+    for record_id, body in records:
+        try:
+            update = Update.de_json(body, application.bot) if isinstance(body, dict) else None
+        except Exception: # pylint: disable=broad-except
+            logger.error("Malformed update in record %s", record_id, exc_info=True)
+            update = None
+        if update is None:
+            failed.append(record_id)
+            continue
+        chat = update.effective_chat
+        # updates without a chat are not coalesced with anything
+        key = chat.id if chat else f"record-{record_id}"
+        chats.setdefault(key, []).append((record_id, update))
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHATS)
+
+    async def process_chat(chat_records):
+        async with semaphore:
+            return await process_chat_updates(application, chat_records)
+
+    results = await asyncio.gather(*(process_chat(chat_records) for chat_records in chats.values()))
+    return failed + [record_id for chat_failed in results for record_id in chat_failed]
+
+
+async def process_chat_updates(application, chat_records) -> list:
+    # runs in its own task, so the batch is only visible to the handlers of this chat
+    batch = ChatBatch()
+    current_batch.set(batch)
+
+    failed = []
+    for record_id, update in chat_records:
+        if failed:
+            # keep the order of the chat, everything after a failure is retried as well
+            failed.append(record_id)
+            continue
+        batch.failed = False
+        with metrics.update_metrics(get_handler_label(update)):
+            await application.process_update(update)
+        if batch.failed:
+            failed.append(record_id)
+
+    current_batch.set(None)
+    if batch.bot_data is None:
+        return failed
+
+    saved = False
+    try:
+        with metrics.update_metrics("batch_flush"):
+            try:
+                if batch.reply_update is not None:
+                    await render_reply(batch.reply_text, batch.reply_update, batch.reply_context, batch.bot_data)
+            finally:
+                # the updates are applied, their state is kept even if the reply cannot be shown
+                with metrics.span("save"):
+                    saved = await asyncio.to_thread(batch.bot_data.save2)
+    except Exception: # pylint: disable=broad-except
+        logger.error("Flushing batched updates of chat %s failed", batch.bot_data.chat_id, exc_info=True)
+
+    if not saved:
+        # none of the chat's updates are stored, all of them are redelivered
+        return [record_id for record_id, _ in chat_records]
+
+    return failed
+
+
+def get_batch_response(event, failed: list) -> dict:
+    if "Records" in event:
+        return {"batchItemFailures": [{"itemIdentifier": record_id} for record_id in failed]}
+    return {"statusCode": 200, "body": json.dumps({"failed": failed})}
+
+
+def build_application(update_processor=None, request=None, rate_limiter=None):
+    builder = (
+        ApplicationBuilder()
+        .token(os.getenv("TELEGRAM_TOKEN"))
+        .request(request or HTTPXRequest(connection_pool_size=CONNECTION_POOL_SIZE))
+        .rate_limiter(rate_limiter or PotzRateLimiter())
+    )
+    if update_processor is not None:
+        builder = builder.concurrent_updates(update_processor)
+    application = builder.build()
+    register_handlers(application)
+    return application
+
+
+def use_chat_sessions(sessions):
+    """
+    Keeps chat state in memory between updates and leaves saving to the sessions' write behind
+    """
+    global chat_sessions # pylint: disable=global-statement
+    chat_sessions = sessions
+
+
+def get_app():
+    global app # pylint: disable=global-statement
+    if app is None:
+        app = build_application()
+        if PERSISTENT_APP:
+            atexit.register(shutdown_app)
+            signal.signal(signal.SIGTERM, handle_sigterm)
+    return app
+
+
+def get_event_loop():
+    global event_loop # pylint: disable=global-statement
+    if event_loop is None or event_loop.is_closed():
+        event_loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(event_loop)
+    return event_loop
+
+
+def shutdown_app():
+    global is_app_initialized # pylint: disable=global-statement
+    if event_loop is None or event_loop.is_closed():
+        return
+    try:
+        if is_app_initialized:
+            is_app_initialized = False
+            event_loop.run_until_complete(app.shutdown())
+    except Exception: # pylint: disable=broad-except
+        logger.error("Application shutdown failed", exc_info=True)
+    finally:
+        event_loop.close()
+
+
+def handle_sigterm(_signum, _frame):
+    # lambda sends SIGTERM before the container is torn down
+    shutdown_app()
+    raise SystemExit(0)
+
+
+async def parse_update(update: Update, scope: StateScope = StateScope.full) -> BotData:
+    if chat_sessions is not None:
+        return await parse_warm_update(update)
+
+    batch = current_batch.get()
+    if batch is not None and batch.bot_data is not None:
+        botData = batch.bot_data
+        botData.bind_update(update)
+    else:
+        botData = BotData(update)
+        with metrics.span("load_state"):
+            if batch is None:
+                botData.load_state(scope)
+            else:
+                # all updates of a batch share one BotData, so it needs the full state.
+                # boto3 blocks, the other chats of the batch keep running meanwhile
+                await asyncio.to_thread(botData.load_state, StateScope.full)
+        if batch is not None:
+            batch.bot_data = botData
+    set_state_dimension(botData)
+    return botData
 
 
-async def parse_update(update: Update) -> BotData:
-    botData = BotData(update)
-    await botData.throttle()
+async def parse_warm_update(update: Update) -> BotData:
+    # the chat's lock is held by the update processor, nothing else touches this BotData meanwhile
+    chat_id = update.effective_chat.id
+    botData = chat_sessions.get(chat_id)
+    if botData is not None:
+        botData.bind_update(update)
+        botData.sent_messages = False
+    else:
+        botData = BotData(update)
+        with metrics.span("load_state"):
+            await asyncio.to_thread(botData.load_state, StateScope.full)
+        chat_sessions.put(chat_id, botData)
+    set_state_dimension(botData)
     return botData
 
 
+def set_state_dimension(botData: BotData):
+    if botData.scope != StateScope.none:
+        metrics.set_dimension("State", botData.state_machine.get_state().name)
+
+
+def save_state(botData: BotData):
+    if current_batch.get() is not None:
+        # saved once, when all updates of the chat's batch are applied
+        return
+    if chat_sessions is not None:
+        chat_sessions.mark_dirty(botData.chat_id)
+        return
+    with metrics.span("save"):
+        botData.save2()
+
+
 async def reply(text: str, update: Update, context: ContextTypes.DEFAULT_TYPE, botData: BotData):
+    batch = current_batch.get()
+    if batch is None:
+        try:
+            await render_reply(text, update, context, botData)
+        finally:
+            # the handler already changed the state, it is kept even if the reply cannot be shown
+            save_state(botData)
+        return
+
+    # button presses only change the keyboard message, so only the last one of a batch is rendered.
+    # command replies carry their own text and are sent once a later reply supersedes them
+    if batch.reply_update is not None and batch.reply_update.callback_query is None:
+        await render_reply(batch.reply_text, batch.reply_update, batch.reply_context, botData)
+    batch.reply_text = text
+    batch.reply_update = update
+    batch.reply_context = context
+
+
+async def render_reply(text: str, update: Update, context: ContextTypes.DEFAULT_TYPE, botData: BotData):
+    """
+    Shows the reply with the inline keyboard
+    """
     try:
         if len(text) < 60:
             # append text with whitespace to 50 chars:
             text += " " * (59 - len(text))
             text += '.'
 
-        message = await context.bot.send_message(
+        with metrics.span("keyboard"):
+            reply_markup, fingerprint = botData.render_keyboard()
+        render_hash = get_render_hash(text, fingerprint)
+
+        # a button press updates the message it came from, unless other messages were sent below it
+        query = update.callback_query
+        if query and query.message and not botData.sent_messages:
+            if await botData.edit_inline_message(query.message.message_id, text, reply_markup, render_hash, context):
+                return
+
+        # the new message takes over the keyboard, the old one is cleared while it is being sent.
+        # the reply is started first, so it also gets the first rate limiter tokens
+        botData.cleanup_inline_message(context)
+        sending = asyncio.ensure_future(context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=text,
-            reply_markup=botData.get_inline_keyboard(),
-        )
-    except RetryAfter:
-        logger.error("Rate limited by telegram, exiting without saving", exc_info=True)
+            reply_markup=reply_markup,
+        ))
+        await botData.outbound.flush()
+        message = await sending
+    except (RetryAfter, PotzRateLimitException):
+        # the rate limiter already retried or would wait too long, keep the state and let the next reply render it
+        logger.warning("Rate limited by telegram, saving without showing the reply", exc_info=True)
         return
+    finally:
+        await botData.outbound.flush()
 
     if message:
-        await botData.set_inline_message_id(message.message_id, context)
+        botData.set_inline_message_id(message.message_id, context)
+        botData.render_hash = render_hash
+
+
+async def reply_text(text: str, update: Update, context: ContextTypes.DEFAULT_TYPE, botData: BotData):
+    """
+    Reply for informational commands, leaves the inline keyboard and the game state alone
+    """
+    try:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=text,
+        )
+    except (RetryAfter, PotzRateLimitException):
+        logger.warning("Rate limited by telegram, the reply is dropped", exc_info=True)
+    finally:
+        save_state(botData)
 
-    botData.save2()
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    botData = await parse_update(update)
+    botData = await parse_update(update, StateScope.none)
 
     help_text = get_client_help_message()
 
-    await reply(help_text, update, context, botData)
+    await reply_text(help_text, update, context, botData)
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    botData = await parse_update(update)
+    botData = await parse_update(update, StateScope.none)
 
     start_text = "Welcome to the bot, potz!"
 
-    await reply(start_text, update, context, botData)
+    await reply_text(start_text, update, context, botData)
 
 
 async def roll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Parse update to get bot data
     botData = await parse_update(update)
 
-    res = await botData.process("roll", context)
+    with metrics.span("process"):
+        res = await botData.process("roll", context)
     return await reply(res, update, context, botData)
 
 
+async def roll_expression_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    botData = await parse_update(update, StateScope.none)
+
+    res = botData.roll_expression(context)
+
+    return await reply_text(res, update, context, botData)
+
+
+async def odds_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    botData = await parse_update(update, StateScope.none)
+
+    res = botData.show_odds(context)
+
+    return await reply_text(res, update, context, botData)
+
+
+async def card_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    botData = await parse_update(update, StateScope.none)
+
+    res = await botData.show_cards(context)
+    if not res:
+        # the cards themselves are the reply
+        save_state(botData)
+        return
+
+    return await reply_text(res, update, context, botData)
+
+
 async def add_hero_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     botData = await parse_update(update)
 
-    res = botData.add_hero(context)
+    with metrics.span("process"):
+        res = botData.add_hero(context)
 
     return await reply(res, update, context, botData)
 
@@ -96,7 +455,8 @@ async def add_hero_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def remove_hero_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     botData = await parse_update(update)
 
-    res = botData.remove_hero(context)
+    with metrics.span("process"):
+        res = botData.remove_hero(context)
 
     return await reply(res, update, context, botData)
 
@@ -104,7 +464,8 @@ async def remove_hero_command(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def add_timer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     botData = await parse_update(update)
 
-    res = botData.add_timer(context)
+    with metrics.span("process"):
+        res = botData.add_timer(context)
 
     return await reply(res, update, context, botData)
 
@@ -116,28 +477,53 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Check if the callback data is a valid state
     if botData.params:
-        res = await botData.process(botData.params[0], context)
+        with metrics.span("process"):
+            res = await botData.process(botData.params[0], context)
 
     await reply(res, update, context, botData)
 
 
 async def privacy_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    botData = await parse_update(update)
+    botData = await parse_update(update, StateScope.none)
 
     res = """
 This bot does not store or process any Personal data.
 The only data stored is the fictional data you provide for the game,
 it is tied to the telegram chat ID and is stored in the database."
 """
-    return await reply(res, update, context, botData)
+    return await reply_text(res, update, context, botData)
 
 
 # error handler, logs the error and sends the message to the chat if debug mode is enabled
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if (batch := current_batch.get()) is not None:
+        batch.failed = True
+
     if type(context.error) == PotzRateLimitException:
         # ignore rate limit exceptions, they are valid and already logged as warnings
         return
 
+    error = context.error
+    fingerprint = get_fingerprint(error)
+    decision, stats, previously_suppressed = error_reporter.record(fingerprint)
+    metrics.count("errors")
+    if previously_suppressed:
+        logger.error("Error %s was suppressed %s more times in the last window", fingerprint, previously_suppressed)
+
+    if decision == ErrorReporter.SUPPRESSED:
+        metrics.count("errors_suppressed")
+        return
+    if decision == ErrorReporter.SAMPLED:
+        logger.error(
+            "Error %s (%s: %s) occurred %s times in this window, %s total",
+            fingerprint, type(error).__name__, error, stats.in_window, stats.total,
+        )
+        return
+
+    logger.error("Error %s: %s", fingerprint, format_error_report(update, context), exc_info=error)
+
+
+def format_error_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
     import html
 
     tb_list = traceback.format_exception(
@@ -146,7 +532,7 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tb_string = "".join(tb_list)
 
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    message = (
+    return (
         f"An exception was raised while handling an update\n"
         f"<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}"
         "</pre>\n\n"
@@ -155,8 +541,6 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"<pre>{html.escape(tb_string)}</pre>"
     )
 
-    logger.error(message, exc_info=context.error)
-
 
 def register_handlers(application):
     help_handler = CommandHandler("help", help_command)
@@ -168,6 +552,15 @@ def register_handlers(application):
     roll_handler = CommandHandler("roll", roll_command)
     application.add_handler(roll_handler)
 
+    roll_expression_handler = CommandHandler("r", roll_expression_command)
+    application.add_handler(roll_expression_handler)
+
+    odds_handler = CommandHandler("odds", odds_command)
+    application.add_handler(odds_handler)
+
+    card_handler = CommandHandler("card", card_command)
+    application.add_handler(card_handler)
+
     add_hero_handler = CommandHandler("add_hero", add_hero_command)
     application.add_handler(add_hero_handler)
 
@@ -186,14 +579,26 @@ def register_handlers(application):
 
 
 def lambda_handler(event, _context):
-    global is_initialized # pylint: disable=global-statement
     try:
-        if not is_initialized:
-            register_handlers(app)
-            is_initialized = True
-        asyncio.run(tg_bot_main(app, event))
+        application = get_app()
+        body = json.loads(event["body"]) if "body" in event else None
+        records = get_batch_records(event, body)
+        if records is not None:
+            if PERSISTENT_APP:
+                failed = get_event_loop().run_until_complete(tg_bot_batch_persistent(application, records))
+            else:
+                failed = asyncio.run(tg_bot_batch(application, records))
+            return get_batch_response(event, failed)
+
+        if PERSISTENT_APP:
+            get_event_loop().run_until_complete(tg_bot_main_persistent(application, body))
+        else:
+            asyncio.run(tg_bot_main(application, body))
     except Exception as e: # pylint: disable=broad-except
         logger.error("Event handling failed", exc_info=True)
+        if "Records" in event:
+            # any response would acknowledge the whole SQS batch, failing the invocation retries it
+            raise
         return {"statusCode": 500, "body": str(e)}
 
     return {"statusCode": 200, "body": "ok"}
\ No newline at end of file
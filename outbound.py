@@ -0,0 +1,37 @@
+"""
+Outbound telegram requests of an update that nobody waits for, like removing an old inline keyboard.
+
+They are keyed by what they change, so a later request for the same message replaces an earlier one
+and a request for a message that is about to be reused is dropped. They are sent after the interactive
+requests of the update have been started, concurrently with them.
+"""
+
+import asyncio
+import logging
+
+from shared import setup_logging
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+
+class OutboundQueue:
+    def __init__(self):
+        # key -> coroutine function, in the order they were deferred
+        self.pending = {}
+
+    def defer(self, key, request):
+        self.pending.pop(key, None)
+        self.pending[key] = request
+
+    def cancel(self, key):
+        self.pending.pop(key, None)
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        results = await asyncio.gather(*(request() for request in pending.values()), return_exceptions=True)
+        for key, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error("Deferred request %s failed", key, exc_info=result)
@@ -0,0 +1,180 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ability card decks from the cards/<deck>/ folders.
+
+Every image is uploaded to telegram once, the returned file_id is kept in a persistent index
+and every later send goes by file_id.
+"""
+
+import logging
+import os
+from functools import lru_cache
+
+from botocore.exceptions import ClientError
+from telegram import InputMediaPhoto
+from telegram.error import BadRequest
+
+from potzdb import UpdateExpressionBuilder, get_potztable
+from shared import setup_logging
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+CARDS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cards")
+CARD_EXTENSION = ".jpg"
+# telegram limit for the number of photos in a media group
+MEDIA_GROUP_SIZE = 10
+# the file_id index lives in the chat table under a key that can never be a chat id
+CARD_INDEX_KEY = "card_file_ids"
+
+
+@lru_cache(maxsize=1)
+def get_decks() -> dict[str, tuple[str, ...]]:
+    """
+    Deck name -> sorted card names, the position of a card in its deck is its index
+    """
+    decks = {}
+    if not os.path.isdir(CARDS_DIR):
+        return decks
+    for deck in sorted(os.listdir(CARDS_DIR)):
+        deck_dir = os.path.join(CARDS_DIR, deck)
+        if os.path.isdir(deck_dir):
+            decks[deck] = tuple(sorted(
+                name[:-len(CARD_EXTENSION)] for name in os.listdir(deck_dir) if name.endswith(CARD_EXTENSION)
+            ))
+    return decks
+
+
+@lru_cache(maxsize=1)
+def get_deck_names() -> tuple[str, ...]:
+    """
+    Deck names in a fixed order, callbacks refer to decks by their position here
+    """
+    return tuple(get_decks())
+
+
+def find_card(deck: str, name: str):
+    """
+    Returns the card with this name or the only card starting with it, None otherwise
+    """
+    cards = get_decks().get(deck, ())
+    if name in cards:
+        return name
+    matches = [card for card in cards if card.startswith(name)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def get_card_path(deck: str, card: str) -> str:
+    return os.path.join(CARDS_DIR, deck, card + CARD_EXTENSION)
+
+
+class CardFileIndex:
+    """
+    card key -> telegram file_id, loaded from the table once per container
+    """
+
+    def __init__(self):
+        self.file_ids = None
+
+    def load(self):
+        self.file_ids = {}
+        try:
+            response = get_potztable().get_item(Key={'chat_id': CARD_INDEX_KEY})
+            item = response.get('Item', {})
+            self.file_ids = {k: v for k, v in item.items() if k != 'chat_id'}
+        except ClientError:
+            logger.error("Error loading card file ids", exc_info=True)
+
+    def get(self, key: str):
+        if self.file_ids is None:
+            self.load()
+        return self.file_ids.get(key)
+
+    def remember(self, file_ids: dict[str, str]):
+        """
+        Stores new file ids with a single write
+        """
+        if self.file_ids is None:
+            self.load()
+        new_file_ids = {k: v for k, v in file_ids.items() if self.file_ids.get(k) != v}
+        if not new_file_ids:
+            return
+        self.file_ids.update(new_file_ids)
+
+        builder = UpdateExpressionBuilder()
+        for key, file_id in new_file_ids.items():
+            builder.set(builder.name(key), file_id)
+        try:
+            get_potztable().update_item(**builder.build({'chat_id': CARD_INDEX_KEY}))
+        except ClientError:
+            logger.error("Error saving card file ids", exc_info=True)
+
+    def forget(self, key: str):
+        self.file_ids.pop(key, None)
+
+
+card_index = CardFileIndex()
+
+
+def get_card_key(deck: str, card: str) -> str:
+    return f"{deck}/{card}"
+
+
+async def send_card(bot, chat_id, deck: str, card: str):
+    key = get_card_key(deck, card)
+    file_id = card_index.get(key)
+    if file_id is not None:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id)
+        except BadRequest:
+            logger.warning("Card file id for %s is no longer valid, uploading again", key)
+            card_index.forget(key)
+
+    with open(get_card_path(deck, card), "rb") as photo:
+        message = await bot.send_photo(chat_id=chat_id, photo=photo)
+    card_index.remember({key: message.photo[-1].file_id})
+    return message
+
+
+async def send_cards(bot, chat_id, deck: str, cards: list[str]):
+    """
+    Sends the cards as media groups, a single card is sent as a plain photo
+    """
+    if len(cards) == 1:
+        await send_card(bot, chat_id, deck, cards[0])
+        return
+
+    for start in range(0, len(cards), MEDIA_GROUP_SIZE):
+        chunk = cards[start:start + MEDIA_GROUP_SIZE]
+        try:
+            await send_media_group(bot, chat_id, deck, chunk, use_file_ids=True)
+        except BadRequest:
+            logger.warning("Media group with cached file ids failed, uploading %s again", deck)
+            await send_media_group(bot, chat_id, deck, chunk, use_file_ids=False)
+
+
+async def send_media_group(bot, chat_id, deck: str, cards: list[str], use_file_ids: bool):
+    media = []
+    files = []
+    try:
+        for card in cards:
+            file_id = card_index.get(get_card_key(deck, card)) if use_file_ids else None
+            if file_id is None:
+                photo = open(get_card_path(deck, card), "rb") # pylint: disable=consider-using-with
+                files.append(photo)
+            else:
+                photo = file_id
+            media.append(InputMediaPhoto(media=photo))
+
+        messages = await bot.send_media_group(chat_id=chat_id, media=media)
+    finally:
+        for photo in files:
+            photo.close()
+
+    card_index.remember({
+        get_card_key(deck, card): message.photo[-1].file_id
+        for card, message in zip(cards, messages)
+        if message.photo
+    })
@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Dice expression engine: parses expressions like 4d6kh1, 2d20+5, 3d6!, 6d10>=8 once
+and evaluates them with batched draws from a shared random source.
+
+Supported terms, joined with + or -:
+    NdM     - N dice with M sides (N defaults to 1, d% is d100)
+    NdM!    - exploding dice, every maximum roll adds another die
+    khK/klK - keep the K highest/lowest dice (K defaults to 1)
+    >=T ... - pool: count the dice matching >=, >, <= or < T instead of summing them
+    C       - a constant
+"""
+
+import random
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+MAX_DICE = 100
+MAX_SIDES = 1000
+MAX_TERMS = 10
+MAX_EXPLOSIONS = 50
+MAX_EXPRESSION_LENGTH = 64
+
+# seeded from the OS entropy source once and reused for every roll
+rng = random.Random()
+
+TERM_RE = re.compile(
+    r"\s*(?P<sign>[+-])?\s*(?:"
+    r"(?P<count>\d*)d(?P<sides>\d+|%)(?P<explode>!)?"
+    r"(?:k(?P<keep>[hl]?)(?P<keep_count>\d*))?"
+    r"(?:(?P<compare>>=|<=|>|<)(?P<target>\d+))?"
+    r"|(?P<constant>\d+))\s*"
+)
+
+COMPARISONS = {
+    ">=": lambda value, target: value >= target,
+    "<=": lambda value, target: value <= target,
+    ">": lambda value, target: value > target,
+    "<": lambda value, target: value < target,
+}
+
+
+class DiceError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class DiceTerm:
+    sign: int
+    count: int
+    sides: int
+    explode: bool = False
+    keep: str = ""
+    keep_count: int = 0
+    compare: str = ""
+    target: int = 0
+
+    def __str__(self):
+        text = f"{'-' if self.sign < 0 else ''}{self.count}d{self.sides}"
+        if self.explode:
+            text += "!"
+        if self.keep:
+            text += f"k{self.keep}{self.keep_count}"
+        if self.compare:
+            text += f"{self.compare}{self.target}"
+        return text
+
+    def draw(self, times: int) -> list[list[int]]:
+        """
+        Rolls the dice of this term for `times` independent rolls with a single batched draw
+        """
+        faces = range(1, self.sides + 1)
+        values = rng.choices(faces, k=self.count * times)
+        rolls = [values[i:i + self.count] for i in range(0, len(values), self.count)]
+        if self.explode and self.sides > 1:
+            for dice in rolls:
+                explosions = dice.count(self.sides)
+                while explosions and len(dice) < self.count + MAX_EXPLOSIONS:
+                    extra = rng.choices(faces, k=explosions)
+                    dice.extend(extra)
+                    explosions = extra.count(self.sides)
+        return rolls
+
+    def kept(self, dice: list[int]) -> list[int]:
+        if not self.keep:
+            return dice
+        ordered = sorted(dice, reverse=self.keep == "h")
+        return ordered[:self.keep_count]
+
+    def value(self, kept: list[int]) -> int:
+        if self.compare:
+            matches = COMPARISONS[self.compare]
+            return self.sign * sum(1 for die in kept if matches(die, self.target))
+        return self.sign * sum(kept)
+
+
+@dataclass(frozen=True)
+class DiceRoll:
+    expression: "DiceExpression"
+    dice: tuple
+    total: int
+
+    def __str__(self):
+        parts = []
+        for term, kept in zip(self.expression.dice_terms, self.dice):
+            parts.append(f"{term}: [{', '.join(map(str, kept))}]")
+        if self.expression.constant:
+            parts.append(f"{self.expression.constant:+d}")
+        return f"{' '.join(parts)} = {self.total}"
+
+
+@dataclass(frozen=True)
+class DiceExpression:
+    text: str
+    dice_terms: tuple
+    constant: int
+
+    def roll(self) -> DiceRoll:
+        all_kept = []
+        total = self.constant
+        for term in self.dice_terms:
+            kept = term.kept(term.draw(1)[0])
+            all_kept.append(tuple(kept))
+            total += term.value(kept)
+        return DiceRoll(self, tuple(all_kept), total)
+
+    def roll_many(self, times: int) -> list[int]:
+        """
+        Totals of `times` independent rolls, drawing each term's dice for all rolls at once
+        """
+        totals = [self.constant] * times
+        for term in self.dice_terms:
+            for i, dice in enumerate(term.draw(times)):
+                totals[i] += term.value(term.kept(dice))
+        return totals
+
+
+@lru_cache(maxsize=256)
+def parse(expression: str) -> DiceExpression:
+    text = expression.lower().strip()
+    if not text or len(text) > MAX_EXPRESSION_LENGTH:
+        raise DiceError(f"Dice expression should be 1 to {MAX_EXPRESSION_LENGTH} characters long")
+
+    dice_terms = []
+    constant = 0
+    position = 0
+    while position < len(text):
+        match = TERM_RE.match(text, position)
+        if not match or match.end() == position:
+            raise DiceError(f"Cannot parse dice expression at '{text[position:]}'")
+        if position > 0 and not match.group("sign"):
+            raise DiceError(f"Expected + or - before '{text[position:]}'")
+        position = match.end()
+
+        sign = -1 if match.group("sign") == "-" else 1
+        if match.group("constant") is not None:
+            constant += sign * int(match.group("constant"))
+            continue
+        dice_terms.append(parse_term(sign, match))
+
+    if len(dice_terms) > MAX_TERMS:
+        raise DiceError(f"At most {MAX_TERMS} dice terms are allowed")
+
+    return DiceExpression(text, tuple(dice_terms), constant)
+
+
+def parse_term(sign: int, match: re.Match) -> DiceTerm:
+    count = int(match.group("count")) if match.group("count") else 1
+    sides = 100 if match.group("sides") == "%" else int(match.group("sides"))
+    if not 1 <= count <= MAX_DICE:
+        raise DiceError(f"Dice count should be between 1 and {MAX_DICE}")
+    if not 1 <= sides <= MAX_SIDES:
+        raise DiceError(f"Dice sides should be between 1 and {MAX_SIDES}")
+
+    keep = match.group("keep")
+    keep_count = 0
+    if keep is not None:
+        keep = keep or "h"
+        keep_count = int(match.group("keep_count")) if match.group("keep_count") else 1
+        if not 1 <= keep_count <= count:
+            raise DiceError(f"Can only keep between 1 and {count} dice")
+
+    return DiceTerm(
+        sign=sign,
+        count=count,
+        sides=sides,
+        explode=match.group("explode") is not None,
+        keep=keep or "",
+        keep_count=keep_count,
+        compare=match.group("compare") or "",
+        target=int(match.group("target")) if match.group("target") else 0,
+    )
+
+
+def roll(expression: str) -> DiceRoll:
+    return parse(expression).roll()
+
+
+def roll_many(expression: str, times: int) -> list[int]:
+    return parse(expression).roll_many(times)
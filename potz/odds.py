@@ -0,0 +1,159 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Outcome probabilities for dice pools and NdM expressions.
+
+Distributions are built one die at a time as float probabilities, a die is added in time linear
+in the size of the distribution. Results are memoized per expression and the Forged in the Dark
+pool table is precomputed at import.
+"""
+
+from functools import lru_cache
+from itertools import accumulate
+from operator import add, sub
+
+from potz.dice import DiceError, parse
+
+
+MAX_POOL = 10
+MAX_OUTCOMES = 2000
+# adding a die costs the size of the distribution, this bounds the work per expression
+MAX_DICE = 200
+PERCENTILES = (10, 25, 50, 75, 90)
+
+# per die result in a pool: (failure 1-3, partial 4-5, six), out of 6
+POOL_DIE = (3, 2, 1)
+
+
+def add_fair_die(probabilities: list[float], sides: int) -> list[float]:
+    """
+    Distribution of the sum plus a fair die: every total is a window of `sides` previous totals,
+    the difference of two prefix sums. map keeps the per element work out of the interpreter.
+    """
+    prefix = list(accumulate(probabilities))
+    upper = prefix + [prefix[-1]] * (sides - 1)
+    lower = [0.0] * sides + prefix[:-1]
+    return list(map((1 / sides).__mul__, map(sub, upper, lower)))
+
+
+def add_binary_die(probabilities: list[float], hit: float) -> list[float]:
+    """
+    Distribution of the count plus a die that hits with probability `hit`
+    """
+    misses = map((1 - hit).__mul__, probabilities + [0.0])
+    hits = map(hit.__mul__, [0.0] + probabilities)
+    return list(map(add, misses, hits))
+
+
+def compute_pool_odds(pool: int) -> tuple[float, float, float, float]:
+    """
+    (critical, success, partial, failure) probabilities of a pool of d6, taking the highest die.
+    Critical needs two or more sixes, an empty pool rolls 2d6 and takes the lowest without crits.
+    """
+    if pool == 0:
+        at_least_six = 1
+        at_least_four = 3 * 3
+        return 0.0, at_least_six / 36, (at_least_four - at_least_six) / 36, 1 - at_least_four / 36
+
+    # weights per state (best die category, number of sixes capped at 2), convolved one die at a time
+    states = {(0, 0): 1}
+    for _ in range(pool):
+        next_states = {}
+        for (best, sixes), weight in states.items():
+            for category, die_weight in enumerate(POOL_DIE):
+                key = (max(best, category), min(2, sixes + (category == 2)))
+                next_states[key] = next_states.get(key, 0) + weight * die_weight
+        states = next_states
+
+    total = 6 ** pool
+    critical = sum(w for (_, sixes), w in states.items() if sixes == 2) / total
+    success = sum(w for (_, sixes), w in states.items() if sixes == 1) / total
+    partial = sum(w for (best, _), w in states.items() if best == 1) / total
+    failure = sum(w for (best, _), w in states.items() if best == 0) / total
+    return critical, success, partial, failure
+
+
+POOL_ODDS = tuple(compute_pool_odds(pool) for pool in range(MAX_POOL + 1))
+
+
+def get_pool_odds(pool: int) -> tuple[float, float, float, float]:
+    if not 0 <= pool <= MAX_POOL:
+        raise DiceError(f"Pool size should be between 0 and {MAX_POOL}")
+    return POOL_ODDS[pool]
+
+
+def format_pool_odds(pool: int) -> str:
+    critical, success, partial, failure = get_pool_odds(pool)
+    return f"{pool}d: {critical:.0%} / {success:.0%} / {partial:.0%} / {failure:.0%}"
+
+
+def format_pool_table(max_pool: int = 6) -> str:
+    lines = ["Odds (crit / success / partial / fail):"]
+    lines.extend(format_pool_odds(pool) for pool in range(max_pool + 1))
+    return "\n".join(lines)
+
+
+def compare_value(value: int, compare: str, target: int) -> bool:
+    if compare == ">=":
+        return value >= target
+    if compare == "<=":
+        return value <= target
+    if compare == ">":
+        return value > target
+    return value < target
+
+
+@lru_cache(maxsize=256)
+def expression_distribution(expression: str) -> tuple[int, tuple]:
+    """
+    (lowest total, probabilities) of a dice expression, only plain sums and pools are supported
+    """
+    parsed = parse(expression)
+    terms = parsed.dice_terms
+    if any(term.explode or term.keep for term in terms):
+        raise DiceError("Odds are only available for plain NdM sums and pools")
+    # every die grows the distribution by its span, bound the total before computing anything
+    span = sum(term.count * (term.sides - 1 if not term.compare else 1) for term in terms) + 1
+    if span > MAX_OUTCOMES or sum(term.count for term in terms) > MAX_DICE:
+        raise DiceError("Too many outcomes to compute the odds")
+
+    lowest, probabilities = parsed.constant, [1.0]
+    for term in terms:
+        if term.compare:
+            matches = sum(1 for value in range(1, term.sides + 1) if compare_value(value, term.compare, term.target))
+            hit = matches / term.sides
+            if term.sign < 0:
+                # -k successes: a hit moves the total one down
+                lowest -= term.count
+                hit = 1 - hit
+            for _ in range(term.count):
+                probabilities = add_binary_die(probabilities, hit)
+        else:
+            # a fair die is symmetric, subtracting it only moves the lowest total
+            lowest += term.count if term.sign > 0 else -term.count * term.sides
+            for _ in range(term.count):
+                probabilities = add_fair_die(probabilities, term.sides)
+    return lowest, tuple(probabilities)
+
+
+def format_expression_odds(expression: str) -> str:
+    lowest, weights = expression_distribution(expression)
+    total = sum(weights)
+    mean = sum((lowest + i) * w for i, w in enumerate(weights)) / total
+    lines = [f"{parse(expression).text}: mean {mean:.2f}, range {lowest} to {lowest + len(weights) - 1}"]
+
+    if len(weights) <= 20:
+        remaining = total
+        for i, weight in enumerate(weights):
+            lines.append(f"{lowest + i} or more: {remaining / total:.1%}")
+            remaining -= weight
+        return "\n".join(lines)
+
+    cumulative = 0
+    percentiles = list(PERCENTILES)
+    for i, weight in enumerate(weights):
+        cumulative += weight
+        while percentiles and cumulative * 100 >= percentiles[0] * total:
+            lines.append(f"{percentiles.pop(0)}th percentile: {lowest + i}")
+    return "\n".join(lines)
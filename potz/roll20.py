@@ -1,14 +1,14 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import random
-
 from telegram import Update
 from telegram.ext import ContextTypes
 
+from potz.dice import rng
+
 
 async def roll20(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Rolling... {}".format(random.SystemRandom().randint(1, 20)),
+        text="Rolling... {}".format(rng.randint(1, 20)),
     )
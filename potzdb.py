@@ -0,0 +1,146 @@
+"""
+DynamoDB helpers for the potz_manager table
+"""
+
+import metrics
+
+POTZ_TABLE = "potz_manager"
+
+# created on first use, a cold start that never touches the table does not pay for boto3
+potztable = None
+
+
+class PotzTable:
+    """
+    Resource-style Table interface on top of the low-level client, which is much cheaper to create
+    """
+
+    def __init__(self, table_name: str):
+        import boto3
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+        self.table_name = table_name
+        self.client = boto3.client('dynamodb')
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def serialize(self, values: dict) -> dict:
+        return {k: self.serializer.serialize(v) for k, v in values.items()}
+
+    def deserialize(self, values: dict) -> dict:
+        return {k: self.deserializer.deserialize(v) for k, v in values.items()}
+
+    def prepare(self, kwargs: dict) -> dict:
+        kwargs = dict(kwargs, TableName=self.table_name)
+        for name in ('Key', 'Item', 'ExpressionAttributeValues'):
+            if name in kwargs:
+                kwargs[name] = self.serialize(kwargs[name])
+        return kwargs
+
+    def get_item(self, **kwargs) -> dict:
+        with metrics.span("dynamodb_get"):
+            response = self.client.get_item(**self.prepare(kwargs))
+        if metrics.is_active():
+            metrics.count("dynamodb_read_bytes", metrics.get_payload_size(response.get('Item')), "Bytes")
+        if 'Item' in response:
+            response['Item'] = self.deserialize(response['Item'])
+        return response
+
+    def put_item(self, **kwargs) -> dict:
+        request = self.prepare(kwargs)
+        with metrics.span("dynamodb_put"):
+            response = self.client.put_item(**request)
+        if metrics.is_active():
+            metrics.count("dynamodb_write_bytes", metrics.get_payload_size(request['Item']), "Bytes")
+        return response
+
+    def update_item(self, **kwargs) -> dict:
+        request = self.prepare(kwargs)
+        with metrics.span("dynamodb_update"):
+            response = self.client.update_item(**request)
+        if metrics.is_active():
+            metrics.count("dynamodb_write_bytes", metrics.get_payload_size(request.get('ExpressionAttributeValues')), "Bytes")
+            metrics.count("dynamodb_read_bytes", metrics.get_payload_size(response.get('Attributes')), "Bytes")
+        if 'Attributes' in response:
+            response['Attributes'] = self.deserialize(response['Attributes'])
+        return response
+
+
+def get_potztable():
+    global potztable # pylint: disable=global-statement
+    if potztable is None:
+        potztable = PotzTable(POTZ_TABLE)
+    return potztable
+
+
+def set_potztable(table):
+    """
+    Replaces the table, e.g. with the in-memory stand-in of tools/standins.py
+    """
+    global potztable # pylint: disable=global-statement
+    potztable = table
+
+
+class UpdateExpressionBuilder:
+    """
+    Collects SET/ADD/REMOVE actions and conditions with generated attribute name and value placeholders
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.values = {}
+        self.assignments = []
+        self.additions = []
+        self.removals = []
+        self.conditions = []
+
+    def name(self, attribute: str) -> str:
+        for placeholder, existing in self.names.items():
+            if existing == attribute:
+                return placeholder
+        placeholder = f'#n{len(self.names)}'
+        self.names[placeholder] = attribute
+        return placeholder
+
+    def value(self, value) -> str:
+        placeholder = f':v{len(self.values)}'
+        self.values[placeholder] = value
+        return placeholder
+
+    def set(self, path: str, value):
+        self.assignments.append(f'{path} = {self.value(value)}')
+
+    def increment(self, path: str, delta: int):
+        self.assignments.append(f'{path} = {path} + {self.value(delta)}')
+
+    def add(self, path: str, value):
+        self.additions.append(f'{path} {self.value(value)}')
+
+    def remove(self, path: str):
+        self.removals.append(path)
+
+    def condition(self, condition: str):
+        self.conditions.append(condition)
+
+    def build(self, key: dict) -> dict:
+        actions = []
+        if self.assignments:
+            actions.append('SET ' + ', '.join(self.assignments))
+        if self.additions:
+            actions.append('ADD ' + ', '.join(self.additions))
+        if self.removals:
+            actions.append('REMOVE ' + ', '.join(self.removals))
+
+        kwargs = {
+            'Key': key,
+            'UpdateExpression': ' '.join(actions),
+            'ExpressionAttributeNames': self.names,
+            'ExpressionAttributeValues': self.values,
+        }
+        if self.conditions:
+            kwargs['ConditionExpression'] = ' AND '.join(self.conditions)
+        return kwargs
+
+
+def is_conditional_check_failure(error) -> bool:
+    return error.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
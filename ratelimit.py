@@ -0,0 +1,162 @@
+"""
+Outbound rate limiting of the bot's requests to telegram.
+
+Every request that posts to a chat takes a token from the global bucket and from its chat's bucket,
+waiting in line until both have one. Budgets follow telegram's limits: about 30 messages per second
+overall, one per second on average in a private chat with short bursts, and 20 per minute in a group.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+from shared import setup_logging, PotzRateLimitException
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+# a full roll goes out without waiting: up to six dice, the summary and the reply, with room to spare
+PRIVATE_CHAT_BURST = 10
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 20
+# a request that would have to wait longer than this is dropped rather than queued
+MAX_WAIT = 10
+MAX_RETRIES = 2
+# buckets of idle chats are full again and can be forgotten
+MAX_CHAT_BUCKETS = 4096
+
+# requests that post something into a chat, everything else (getMe, answerCallbackQuery, ...) is not limited
+LIMITED_PREFIXES = ("send", "edit", "copy", "forward", "delete")
+# only count against the global budget: removing an old keyboard posts nothing new into the chat
+CHAT_EXEMPT_ENDPOINTS = frozenset({"editMessageReplyMarkup"})
+
+
+class TokenBucket:
+    """
+    `rate` tokens per second up to `burst`. Callers reserve tokens in arrival order
+    and sleep until their token is due, so the bucket paces a queue instead of rejecting it.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        """
+        Takes a token, possibly in advance, and returns how long to wait until it is due
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= 1
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.paused_until - now)
+
+    def cancel(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+    def pause(self, seconds: float):
+        # telegram told us to back off, nothing goes out before that
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def is_idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated_at) * self.rate >= self.burst
+
+
+class PotzRateLimiter(BaseRateLimiter):
+    """
+    Global and per chat token buckets shared by all requests of the process, retries after RetryAfter
+    """
+
+    def __init__(self, max_wait: float = MAX_WAIT, max_retries: int = MAX_RETRIES):
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self.chat_buckets = OrderedDict()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def get_chat_bucket(self, chat_id) -> TokenBucket:
+        # requests pass the chat id as int or str, both are the same chat
+        chat_id = str(chat_id)
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if is_group_chat(chat_id):
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self.chat_buckets[chat_id] = bucket
+            self.forget_idle_buckets()
+        self.chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def forget_idle_buckets(self):
+        for chat_id in list(self.chat_buckets):
+            if len(self.chat_buckets) <= MAX_CHAT_BUCKETS:
+                return
+            if self.chat_buckets[chat_id].is_idle():
+                del self.chat_buckets[chat_id]
+
+    async def acquire(self, chat_id):
+        buckets = [self.global_bucket]
+        if chat_id is not None:
+            buckets.append(self.get_chat_bucket(chat_id))
+
+        waits = [bucket.reserve() for bucket in buckets]
+        wait = max(waits)
+        if wait > self.max_wait:
+            for bucket in buckets:
+                bucket.cancel()
+            logger.warning("Chat %s would wait %.1fs for telegram, dropping the request", chat_id, wait)
+            raise PotzRateLimitException(f"Rate limit of chat {chat_id} exceeded")
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(LIMITED_PREFIXES):
+            return await call(callback, args, kwargs, endpoint)
+
+        chat_id = data.get("chat_id")
+        bucket_chat_id = None if endpoint in CHAT_EXEMPT_ENDPOINTS else chat_id
+        max_retries = self.max_retries if rate_limit_args is None else rate_limit_args
+        for attempt in range(max_retries + 1):
+            with metrics.span("rate_limit_wait"):
+                await self.acquire(bucket_chat_id)
+            try:
+                return await call(callback, args, kwargs, endpoint)
+            except RetryAfter as e:
+                if attempt == max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+                logger.warning("Telegram asked to retry %s in chat %s after %ss", endpoint, chat_id, retry_after)
+                bucket = self.global_bucket if bucket_chat_id is None else self.get_chat_bucket(bucket_chat_id)
+                bucket.pause(retry_after)
+
+
+async def call(callback, args, kwargs, endpoint: str):
+    metrics.count("telegram_calls")
+    with metrics.span(f"telegram_{endpoint}"):
+        return await callback(*args, **kwargs)
+
+
+def is_group_chat(chat_id) -> bool:
+    # private chat ids are positive, groups and channels are negative or @usernames
+    try:
+        return int(chat_id) < 0
+    except (TypeError, ValueError):
+        return True
@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Standalone server mode: serves the same handlers as the lambda from a single always-on process,
+either behind a webhook or with long polling.
+
+Different chats are processed in parallel by a bounded pool of workers, updates of one chat are
+strictly serialized. Chat state stays warm in memory and is written behind to the table, so this
+process should be the only writer of the table while it runs.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+import newpotz
+from sessions import ChatSessions
+from shared import setup_logging
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+WORKERS = int(os.getenv("POTZ_WORKERS", "16"))
+# updates waiting for their chat or for a worker, telegram retries whatever is not accepted
+MAX_PENDING_UPDATES = 1024
+MAX_WARM_CHATS = int(os.getenv("POTZ_MAX_WARM_CHATS", "4096"))
+WRITE_BEHIND_INTERVAL = float(os.getenv("POTZ_WRITE_BEHIND_INTERVAL", "2"))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates of different chats concurrently on at most `workers` workers.
+    Updates of one chat wait for its lock first, so a busy chat never holds more than one worker.
+    """
+
+    def __init__(self, sessions: ChatSessions, workers: int):
+        super().__init__(max_concurrent_updates=MAX_PENDING_UPDATES)
+        self.sessions = sessions
+        self.worker_count = workers
+        self.workers = None
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        with metrics.update_metrics(newpotz.get_handler_label(update)):
+            if chat is None:
+                async with self.workers:
+                    await coroutine
+                return
+
+            # asyncio locks are fair, updates of a chat run in the order they arrived
+            with metrics.span("chat_wait"):
+                await self.sessions.acquire(chat.id)
+            try:
+                async with self.workers:
+                    await coroutine
+            finally:
+                self.sessions.release(chat.id)
+
+    async def initialize(self):
+        self.workers = asyncio.Semaphore(self.worker_count)
+        self.sessions.start()
+
+    async def shutdown(self):
+        await self.sessions.stop()
+
+
+def build_server_application(workers: int):
+    sessions = ChatSessions(MAX_WARM_CHATS, WRITE_BEHIND_INTERVAL)
+    newpotz.use_chat_sessions(sessions)
+    return newpotz.build_application(ChatOrderedUpdateProcessor(sessions, workers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--polling", action="store_true", help="use long polling instead of a webhook")
+    parser.add_argument("--webhook-url", default=os.getenv("POTZ_WEBHOOK_URL"), help="public url telegram posts updates to")
+    parser.add_argument("--listen", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8443")))
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    application = build_server_application(args.workers)
+    if args.polling:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+        return
+
+    if not args.webhook_url:
+        parser.error("--webhook-url or POTZ_WEBHOOK_URL is required unless --polling is used")
+    application.run_webhook(
+        listen=args.listen,
+        port=args.port,
+        webhook_url=args.webhook_url,
+        secret_token=os.getenv("POTZ_WEBHOOK_SECRET"),
+        allowed_updates=Update.ALL_TYPES,
+    )
+
+
+if __name__ == "__main__":
+    main()
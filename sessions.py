@@ -0,0 +1,110 @@
+"""
+Warm chat state for the long running server: one BotData per chat stays in memory,
+updates of a chat are serialized by its lock and changes are written behind to the table
+"""
+
+import asyncio
+import logging
+from collections import OrderedDict
+
+from shared import setup_logging
+
+
+logger = setup_logging(logging.INFO, __name__)
+
+
+class ChatSessions:
+    """
+    Per chat lock, warm BotData and dirty flag. Chats are evicted in LRU order once they are saved
+    and nobody holds or waits for their lock.
+    """
+
+    def __init__(self, max_chats: int, flush_interval: float):
+        self.max_chats = max_chats
+        self.flush_interval = flush_interval
+        self.locks = {}
+        # chat id -> number of tasks holding or waiting for the chat's lock
+        self.lock_users = {}
+        self.chats = OrderedDict()
+        self.dirty = set()
+        self.flush_task = None
+
+    async def acquire(self, chat_id):
+        # counted before waiting: a released lock looks unlocked until its next waiter resumes
+        self.lock_users[chat_id] = self.lock_users.get(chat_id, 0) + 1
+        if (lock := self.locks.get(chat_id)) is None:
+            lock = self.locks[chat_id] = asyncio.Lock()
+        try:
+            await lock.acquire()
+        except BaseException:
+            self.release_user(chat_id)
+            raise
+
+    def release(self, chat_id):
+        self.locks[chat_id].release()
+        self.release_user(chat_id)
+
+    def release_user(self, chat_id):
+        if self.lock_users[chat_id] > 1:
+            self.lock_users[chat_id] -= 1
+        else:
+            del self.lock_users[chat_id]
+
+    def get(self, chat_id):
+        bot_data = self.chats.get(chat_id)
+        if bot_data is not None:
+            self.chats.move_to_end(chat_id)
+        return bot_data
+
+    def put(self, chat_id, bot_data):
+        self.chats[chat_id] = bot_data
+        self.chats.move_to_end(chat_id)
+
+    def mark_dirty(self, chat_id):
+        self.dirty.add(chat_id)
+
+    async def flush_chat(self, chat_id):
+        await self.acquire(chat_id)
+        try:
+            if chat_id not in self.dirty:
+                return
+            self.dirty.discard(chat_id)
+            bot_data = self.chats.get(chat_id)
+            if bot_data is not None:
+                # boto3 blocks, keep the event loop serving the other chats meanwhile
+                if not await asyncio.to_thread(bot_data.save2):
+                    # retried with the next flush
+                    self.dirty.add(chat_id)
+        finally:
+            self.release(chat_id)
+
+    async def flush(self):
+        for chat_id in list(self.dirty):
+            try:
+                await self.flush_chat(chat_id)
+            except Exception: # pylint: disable=broad-except
+                logger.error("Write behind of chat %s failed", chat_id, exc_info=True)
+        self.evict()
+
+    def evict(self):
+        for chat_id in list(self.chats):
+            if len(self.chats) <= self.max_chats:
+                break
+            if chat_id in self.dirty or chat_id in self.lock_users:
+                continue
+            del self.chats[chat_id]
+            self.locks.pop(chat_id, None)
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self.run_flusher())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
@@ -0,0 +1,52 @@
+"""
+In-process cache of decoded chat state, shared by updates handled in the same warm container
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class ChatStateCache:
+    """
+    Bounded LRU of (version, attributes) per chat with TTL eviction.
+    The cached version has to be confirmed against the table before the attributes are used.
+    Safe to share between threads, the server loads and saves chats from worker threads.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, chat_id):
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return None
+
+            expires_at, version, attributes = entry
+            if expires_at < time.monotonic():
+                del self.entries[chat_id]
+                return None
+
+            self.entries.move_to_end(chat_id)
+            return version, attributes
+
+    def put(self, chat_id, version: int, attributes: dict):
+        # attribute values are replaced, never mutated in place, so a shallow copy is enough
+        entry = (time.monotonic() + self.ttl, version, dict(attributes))
+        with self.lock:
+            self.entries[chat_id] = entry
+            self.entries.move_to_end(chat_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        with self.lock:
+            self.entries.pop(chat_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,78 @@
+"""
+Concurrent saves of chat state, against the in-memory table of tools/standins.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+# pylint: disable=wrong-import-position
+import pytest
+
+import botdata
+import potzdb
+from botdata import BotData, StateScope
+from potz.cards import get_deck_names
+from standins import InMemoryTable
+
+CHAT_ID = 4242
+
+
+def make_update(user_id: int):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}")
+    message = SimpleNamespace(from_user=user, text="/card")
+    return SimpleNamespace(
+        message=message,
+        edited_message=None,
+        callback_query=None,
+        effective_chat=SimpleNamespace(id=CHAT_ID, type="group"),
+    )
+
+
+@pytest.fixture(name="table")
+def fixture_table():
+    table = InMemoryTable()
+    table.items[str(CHAT_ID)] = {"chat_id": str(CHAT_ID), "state": "root", "decks": {}, "version": 1}
+    potzdb.set_potztable(table)
+    botdata.state_cache.clear()
+    yield table
+    potzdb.set_potztable(None)
+    botdata.state_cache.clear()
+
+
+def load(user_id: int) -> BotData:
+    bot_data = BotData(make_update(user_id))
+    bot_data.load_state(StateScope.full)
+    return bot_data
+
+
+def test_interleaved_draws_keep_both_cards(table):
+    deck = get_deck_names()[0]
+    first, second = load(1), load(2)
+
+    first_card = first.get_deck(0).draw()
+    second_card = second.get_deck(0).draw()
+    first.save2()
+    second.save2()
+
+    stored = table.items[str(CHAT_ID)]["decks"][deck]
+    assert stored["hand"] == (1 << first_card) | (1 << second_card)
+    assert table.conditional_failures == 1
+    assert table.items[str(CHAT_ID)]["version"] == 3
+
+
+def test_interleaved_draw_and_discard(table):
+    deck = get_deck_names()[0]
+    table.items[str(CHAT_ID)]["decks"] = {deck: {"hand": 0b11, "discard": 0}}
+    first, second = load(1), load(2)
+
+    assert first.get_deck(0).discard_card(0)
+    second.get_deck(0).hand |= 1 << 4
+    first.save2()
+    second.save2()
+
+    assert table.items[str(CHAT_ID)]["decks"][deck] == {"hand": 0b10010, "discard": 0b1}
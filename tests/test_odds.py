@@ -0,0 +1,49 @@
+"""
+Odds of dice expressions and their cost
+"""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+import pytest
+
+from potz.dice import DiceError
+from potz.odds import expression_distribution
+
+# as many dice as MAX_DICE allows, with close to MAX_OUTCOMES totals
+WORST_EXPRESSION = "100d11+100d10"
+# a cold Lambda has far less CPU than a laptop, this leaves room below its budget
+MAX_SECONDS = 0.2
+
+
+def test_sums_and_pools():
+    lowest, probabilities = expression_distribution("3d6")
+    assert lowest == 3
+    assert probabilities[10 - lowest] == pytest.approx(27 / 216)
+
+    lowest, probabilities = expression_distribution("4d6>=5-1d6>=6")
+    assert lowest == -1
+    assert probabilities[4 - lowest] == pytest.approx((1 / 3) ** 4 * 5 / 6)
+
+
+def test_worst_expression_is_cheap():
+    expression_distribution.cache_clear()
+    started = time.perf_counter()
+    lowest, probabilities = expression_distribution(WORST_EXPRESSION)
+    elapsed = time.perf_counter() - started
+
+    assert (lowest, len(probabilities)) == (200, 1901)
+    assert sum(probabilities) == pytest.approx(1)
+    assert elapsed < MAX_SECONDS
+
+
+def test_too_many_outcomes():
+    with pytest.raises(DiceError):
+        expression_distribution("100d20+100d20")
+    with pytest.raises(DiceError):
+        expression_distribution("100d2+100d2+1d2")
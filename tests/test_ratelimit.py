@@ -0,0 +1,36 @@
+"""
+Per chat budgets of the outbound rate limiter
+"""
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# pylint: disable=wrong-import-position
+from ratelimit import PRIVATE_CHAT_BURST, PotzRateLimiter
+
+
+async def send():
+    return True
+
+
+def request(limiter: PotzRateLimiter, endpoint: str, chat_id):
+    return limiter.process_request(send, (), {}, endpoint, {"chat_id": chat_id}, None)
+
+
+def test_send_and_edit_share_the_chat_bucket():
+    limiter = PotzRateLimiter()
+
+    async def run():
+        await request(limiter, "sendMessage", 42)
+        await request(limiter, "editMessageText", "42")
+
+    asyncio.run(run())
+
+    assert list(limiter.chat_buckets) == ["42"]
+    assert limiter.chat_buckets["42"].tokens == pytest.approx(PRIVATE_CHAT_BURST - 2, abs=0.1)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks of the hot paths, against the in-memory table and telegram stand-ins of standins.py.
+
+Covers load_state/save2 for parties of 1 to 100 heroes and timers, process for every callback type,
+keyboard rendering and the full lambda_handler path. Reports ops/sec, the peak memory allocated per op
+(tracemalloc) and the table and telegram calls per op.
+
+Usage: python tools/bench.py [--filter load] [--min-time 0.5] [--table-latency 0] [--telegram-latency 0]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+from functools import partial
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:offline-benchmark")
+
+# pylint: disable=wrong-import-position
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import botdata
+import callbacks
+import keyboards
+import metrics
+import newpotz
+import potzdb
+from botdata import CALLBACK_HANDLERS, BotData, StateScope
+from d20potz_state_machine import PotzState
+from standins import (
+    FakeTelegramRequest,
+    InMemoryTable,
+    NoRateLimiter,
+    make_callback_update,
+    make_command_update,
+    make_event,
+)
+
+PARTY_SIZES = (1, 10, 100)
+ALLOCATION_RUNS = 20
+CHAT_ID = 4242
+USER_ID = 7
+INLINE_MESSAGE_ID = 500
+
+KEYBOARD_BUILDERS = (
+    keyboards.build_hero_row, keyboards.build_hero_keyboard,
+    keyboards.build_timer_row, keyboards.build_timer_keyboard,
+    keyboards.build_deck_row, keyboards.build_deck_keyboard,
+    keyboards.build_hand_row, keyboards.build_hand_keyboard,
+)
+
+
+class Bench:
+    def __init__(self, table: InMemoryTable, request: FakeTelegramRequest, min_time: float, name_filter: str):
+        self.table = table
+        self.request = request
+        self.min_time = min_time
+        self.name_filter = name_filter
+        self.loop = newpotz.get_event_loop()
+
+    def call(self, func):
+        result = func()
+        if asyncio.iscoroutine(result):
+            result = self.loop.run_until_complete(result)
+        return result
+
+    def run(self, name: str, func, setup=None):
+        """
+        Times func, setup prepares every single call and is not timed
+        """
+        if self.name_filter and self.name_filter not in name:
+            return
+
+        setup = setup or (lambda: None)
+        ops = 0
+        elapsed = 0.0
+        table_calls = telegram_calls = 0
+        while elapsed < self.min_time:
+            setup()
+            # only the calls of func are counted, not those of the setup
+            self.table.reset_counters()
+            self.request.reset_counters()
+            started = time.perf_counter()
+            self.call(func)
+            elapsed += time.perf_counter() - started
+            ops += 1
+            table_calls += sum(self.table.calls.values())
+            telegram_calls += sum(self.request.calls.values())
+        table_calls /= ops
+        telegram_calls /= ops
+
+        peak = 0
+        tracemalloc.start()
+        try:
+            for _ in range(ALLOCATION_RUNS):
+                setup()
+                current, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                self.call(func)
+                peak += tracemalloc.get_traced_memory()[1] - current
+        finally:
+            tracemalloc.stop()
+
+        print(f"{name:<40} {ops / elapsed:>10.0f} {elapsed / ops * 1e6:>10.1f} {peak / ALLOCATION_RUNS / 1024:>9.1f} "
+              f"{table_calls:>6.1f} {telegram_calls:>6.1f}")
+
+
+def make_item(chat_id: int, party: int, state: PotzState = PotzState.root) -> dict:
+    return {
+        "chat_id": str(chat_id),
+        "state": state.name,
+        "inline_message_id": INLINE_MESSAGE_ID,
+        "render_hash": None,
+        "heroes": [{"id": i, "name": f"hero{i}", "stress": 1, "harm": 1} for i in range(1, party + 1)],
+        "timers": [{"id": i, "name": f"timer{i}", "value": 3} for i in range(1, party + 1)],
+        "decks": {},
+        "version": 1,
+    }
+
+
+def make_update(application, text: str = "/roll") -> Update:
+    return Update.de_json(make_command_update(1, CHAT_ID, USER_ID, text), application.bot)
+
+
+def load_state(update: Update) -> BotData:
+    bot_data = BotData(update)
+    bot_data.load_state(StateScope.full)
+    return bot_data
+
+
+def reset_cold(bench: Bench, item: dict):
+    bench.table.items[str(CHAT_ID)] = dict(item)
+    botdata.state_cache.clear()
+
+
+def reset_warm(bench: Bench, item: dict, update: Update):
+    # the state cache holds the stored version, like a warm container that handled the last update
+    reset_cold(bench, item)
+    load_state(update)
+
+
+def add_stress(bot_data: BotData):
+    next(iter(bot_data.heroes.values())).stress += 1
+
+
+def add_hero(bot_data: BotData):
+    bot_data.heroes[10000] = botdata.PotzHero("newcomer", 0, 0, 10000)
+
+
+def prepare_save(bench: Bench, item: dict, update: Update, change, prepared: dict):
+    reset_cold(bench, item)
+    bot_data = load_state(update)
+    change(bot_data)
+    prepared["bot_data"] = bot_data
+
+
+def save_prepared(prepared: dict):
+    prepared["bot_data"].save2()
+
+
+def bench_state(bench: Bench, application):
+    update = make_update(application)
+
+    for party in PARTY_SIZES:
+        item = make_item(CHAT_ID, party)
+        load = partial(load_state, update)
+        bench.run(f"load_state cold party={party}", load, partial(reset_cold, bench, item))
+        bench.run(f"load_state cached party={party}", load, partial(reset_warm, bench, item, update))
+
+        for name, change in (("counter", add_stress), ("structural", add_hero)):
+            prepared = {}
+            bench.run(
+                f"save2 {name} party={party}",
+                partial(save_prepared, prepared),
+                partial(prepare_save, bench, item, update, change, prepared),
+            )
+
+
+def get_callback_arguments(opcode: str, arity: int, bot_data: BotData) -> tuple:
+    if arity == 0:
+        return ()
+    if opcode in (callbacks.HAND_CARD, callbacks.HAND_DISCARD):
+        deck = bot_data.get_deck(0)
+        return 0, deck.get_hand()[0]
+    if opcode == callbacks.ROLL:
+        return (2,)
+    if opcode.startswith(("d", "c")):
+        return (0,)
+    if opcode.startswith("t"):
+        return (next(iter(bot_data.timers)),)
+    return (next(iter(bot_data.heroes)),)
+
+
+def prepare_process(bench: Bench, application, item: dict, opcode: str, handler, prepared: dict):
+    reset_cold(bench, item)
+    update = Update.de_json(make_callback_update(1, CHAT_ID, USER_ID, INLINE_MESSAGE_ID, opcode), application.bot)
+    bot_data = load_state(update)
+    if PotzState.hand in handler.states:
+        bot_data.get_deck(0).draw()
+    args = get_callback_arguments(opcode, handler.arity, bot_data)
+    prepared["bot_data"] = bot_data
+    prepared["callback"] = callbacks.encode_callback(opcode, *args)
+    prepared["context"] = CallbackContext.from_update(update, application)
+
+
+def process_prepared(prepared: dict):
+    return prepared["bot_data"].process(prepared["callback"], prepared["context"])
+
+
+def bench_process(bench: Bench, application):
+    party = 10
+    for opcode, handler in CALLBACK_HANDLERS.items():
+        item = make_item(CHAT_ID, party, next(iter(handler.states)))
+        prepared = {}
+        bench.run(
+            f"process {opcode!r} ({handler.method.__name__})",
+            partial(process_prepared, prepared),
+            partial(prepare_process, bench, application, item, opcode, handler, prepared),
+        )
+
+
+def clear_keyboard_caches():
+    for builder in KEYBOARD_BUILDERS:
+        builder.cache_clear()
+
+
+def bench_keyboards(bench: Bench, application):
+    update = make_update(application)
+    for party in (10, 100):
+        for state in (PotzState.root, PotzState.stress, PotzState.timer, PotzState.deck, PotzState.hand):
+            bot_data = BotData(update)
+            bot_data.scope = StateScope.full
+            bot_data.apply_item_attributes(botdata.decode_item(make_item(CHAT_ID, party, state)))
+
+            bench.run(f"keyboard {state.name} party={party} cold", bot_data.render_keyboard, clear_keyboard_caches)
+            bench.run(f"keyboard {state.name} party={party} cached", bot_data.render_keyboard)
+
+
+def bench_lambda_handler(bench: Bench, application):
+    newpotz.app = application
+    events = {
+        "command /roll": make_event(make_command_update(1, CHAT_ID, USER_ID, "/roll")),
+        "command /add_hero": make_event(make_command_update(1, CHAT_ID, USER_ID, "/add_hero newcomer 1 1")),
+        "callback stress screen": make_event(make_callback_update(1, CHAT_ID, USER_ID, INLINE_MESSAGE_ID, PotzState.stress.value)),
+        "callback stress +1": make_event(make_callback_update(1, CHAT_ID, USER_ID, INLINE_MESSAGE_ID, callbacks.encode_callback(callbacks.STRESS_PLUS, 1))),
+        "callback roll 3d6": make_event(make_callback_update(1, CHAT_ID, USER_ID, INLINE_MESSAGE_ID, callbacks.encode_callback(callbacks.ROLL, 3))),
+    }
+    states = {
+        "callback stress +1": PotzState.stress,
+        "callback roll 3d6": PotzState.roll,
+    }
+    update = make_update(application)
+    for name, event in events.items():
+        item = make_item(CHAT_ID, 10, states.get(name, PotzState.root))
+        handle = partial(newpotz.lambda_handler, event, None)
+        bench.run(f"lambda_handler {name} cold", handle, partial(reset_cold, bench, item))
+        bench.run(f"lambda_handler {name} warm", handle, partial(reset_warm, bench, item, update))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to run every benchmark for")
+    parser.add_argument("--table-latency", type=float, default=0.0, help="seconds added to every table call")
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="seconds added to every telegram call")
+    args = parser.parse_args()
+
+    # the EMF lines would drown the report
+    metrics.set_enabled(False)
+    table = InMemoryTable(args.table_latency)
+    potzdb.set_potztable(table)
+    request = FakeTelegramRequest(args.telegram_latency)
+    application = newpotz.build_application(request=request, rate_limiter=NoRateLimiter())
+    bench = Bench(table, request, args.min_time, args.filter)
+    bench.call(application.initialize)
+    newpotz.is_app_initialized = True
+
+    print(f"{'benchmark':<40} {'ops/s':>10} {'us/op':>10} {'peak KiB':>9} {'table':>6} {'tg':>6}")
+    bench_state(bench, application)
+    bench_process(bench, application)
+    bench_keyboards(bench, application)
+    bench_lambda_handler(bench, application)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Cold start report for the lambda entry point.
+
+Prints the slowest imports of newpotz (from python -X importtime) and, given a sample event,
+the time from interpreter start to the first and second handled update in a fresh process.
+
+Usage: python tools/coldstart.py [--event event.json] [--top 20]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_MODULE = "newpotz"
+
+# runs in a fresh interpreter so that nothing is imported or initialized yet
+FIRST_UPDATE_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import newpotz
+imported = time.perf_counter()
+event = json.load(open(sys.argv[1]))
+first = newpotz.lambda_handler(event, None)
+handled = time.perf_counter()
+second = newpotz.lambda_handler(event, None)
+warm = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "first_update_ms": (handled - imported) * 1000,
+    "time_to_first_update_ms": (handled - started) * 1000,
+    "warm_update_ms": (warm - handled) * 1000,
+    "status": [first["statusCode"], second["statusCode"]],
+}))
+"""
+
+
+def run_python(args: list[str]) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=False)
+
+
+def import_times(module: str) -> list[tuple[int, int, str]]:
+    result = run_python(["-X", "importtime", "-c", f"import {module}"])
+    if result.returncode != 0:
+        sys.exit(f"import {module} failed:\n{result.stderr}")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            # header line
+            continue
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+
+def print_import_report(module: str, top: int):
+    rows = import_times(module)
+    total_us = next((cumulative for _, cumulative, name in rows if name.strip() == module), 0)
+    print(f"import {module}: {total_us / 1000:.1f} ms total, {len(rows)} modules")
+    print(f"{'self ms':>9} {'cumul ms':>9}  module")
+    for self_us, cumulative_us, name in sorted(rows, key=lambda r: r[1], reverse=True)[:top]:
+        print(f"{self_us / 1000:9.1f} {cumulative_us / 1000:9.1f}  {name}")
+
+
+def print_first_update_report(event_file: str):
+    result = run_python(["-c", FIRST_UPDATE_SCRIPT, os.path.abspath(event_file)])
+    if result.returncode != 0:
+        sys.exit(f"handling {event_file} failed:\n{result.stderr}")
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    print()
+    for name, value in report.items():
+        print(f"{name}: {value:.1f}" if isinstance(value, float) else f"{name}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--event", help="lambda event json to measure time-to-first-handled-update with")
+    parser.add_argument("--top", type=int, default=20, help="number of imports to list")
+    args = parser.parse_args()
+
+    print_import_report(ENTRY_MODULE, args.top)
+    if args.event:
+        print_first_update_report(args.event)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+"""
+Load generator for the update handlers, against the in-memory table and telegram stand-ins of standins.py.
+
+Generates realistic update streams over many synthetic chats (commands, taps on every screen, dice rolls),
+records them, sanitizes real update json for replay and drives them concurrently through the lambda path
+or the server mode. Reports p50/p95/p99 latency, throughput, telegram and table calls per update and
+lost updates: hero and timer counters that differ from a sequential replay of each chat's updates.
+Lost updates are only meaningful for streams that start from an empty table, like generated ones.
+Without --rate the run is closed loop: latency is measured from when a worker or client picks an update up.
+
+Usage:
+    python tools/loadgen.py generate --chats 1000 --updates 20 --out traffic.jsonl
+    python tools/loadgen.py sanitize raw_updates.jsonl --out traffic.jsonl
+    python tools/loadgen.py run [--replay traffic.jsonl] [--mode lambda|server] [--concurrency 32] [--rate 0]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:offline-loadgen")
+
+# pylint: disable=wrong-import-position
+from telegram import Update
+
+import botdata
+import callbacks
+import metrics
+import newpotz
+import potzdb
+from botdata import CALLBACK_HANDLERS, HERO_STEP, MAX_BATCH_ENTRIES, MAX_ROLL_DICE, STATES_BY_VALUE, decode_item
+from callbacks import decode_callback, encode_callback
+from d20potz_state_machine import PotzState, PotzStateMachine
+from sessions import ChatSessions
+from statecache import ChatStateCache
+from standins import FakeTelegramRequest, InMemoryTable, NoRateLimiter, make_callback_update, make_command_update
+
+PLAYERS_PER_CHAT = 4
+MAX_HEROES = 6
+MAX_TIMERS = 3
+# every n-th synthetic chat is a group
+GROUP_EVERY = 4
+KEYBOARD_MESSAGE_ID = 1
+SERVER_FLUSH_INTERVAL = 0.5
+
+# fields of an update that are kept when sanitizing, everything else is dropped
+USER_FIELDS = ("id", "is_bot")
+CHAT_FIELDS = ("id", "type")
+MESSAGE_FIELDS = ("message_id", "date", "text", "entities")
+CALLBACK_FIELDS = ("id", "chat_instance", "data")
+
+
+HERO_DELTAS = {
+    callbacks.STRESS_PLUS: 1, callbacks.STRESS_MINUS: -1, callbacks.STRESS_STEP: HERO_STEP,
+    callbacks.HARM_PLUS: 1, callbacks.HARM_MINUS: -1, callbacks.HARM_STEP: HERO_STEP,
+}
+
+
+class ChatModel:
+    """
+    Sequential model of a chat's heroes, timers and screen, mirrors what the handlers do with an update
+    """
+
+    def __init__(self):
+        self.state = PotzState.root
+        # id -> [name, stress, harm] / [name, value]
+        self.heroes = {}
+        self.timers = {}
+
+    def transition(self, state: PotzState):
+        if (self.state, state) in PotzStateMachine.ALLOWED_TRANSITIONS:
+            self.state = state
+
+    def apply(self, update: dict):
+        if "callback_query" in update:
+            self.apply_callback(update["callback_query"].get("data") or "")
+        elif text := (update.get("message") or {}).get("text"):
+            self.apply_command(text.split())
+
+    def apply_command(self, params: list):
+        command = params[0][1:].split("@")[0]
+        if command == "roll":
+            self.transition(PotzState.roll)
+        elif command == "add_hero":
+            self.add_heroes(params[1:])
+        elif command == "remove_hero" and len(params) == 2:
+            self.heroes = {i: hero for i, hero in self.heroes.items() if hero[0] != params[1]}
+        elif command == "add_timer":
+            self.add_timers(params[1:])
+
+    def add_heroes(self, params: list):
+        entries = []
+        for param in params:
+            if not param.lstrip("-").isdigit():
+                entries.append([param])
+            elif not entries or len(entries[-1]) == 3:
+                return
+            else:
+                entries[-1].append(int(param))
+        if not entries or len(entries) > MAX_BATCH_ENTRIES or any(v < 0 for entry in entries for v in entry[1:]):
+            return
+        for entry in entries:
+            if entry[0] not in {hero[0] for hero in self.heroes.values()}:
+                self.heroes[max(self.heroes, default=0) + 1] = entry + [0] * (3 - len(entry))
+
+    def add_timers(self, params: list):
+        if not params or len(params) % 2 or len(params) // 2 > MAX_BATCH_ENTRIES:
+            return
+        pairs = list(zip(params[::2], params[1::2]))
+        if not all(value.isdigit() and int(value) > 0 for _, value in pairs):
+            return
+        for name, value in pairs:
+            if name not in {timer[0] for timer in self.timers.values()}:
+                self.timers[max(self.timers, default=0) + 1] = [name, int(value)]
+
+    def tick_timers(self):
+        for timer in self.timers.values():
+            timer[1] = max(0, timer[1] - 1)
+
+    def apply_callback(self, data: str):
+        try:
+            opcode, args = decode_callback(data)
+        except ValueError:
+            return
+        if opcode in STATES_BY_VALUE and not args:
+            self.transition(STATES_BY_VALUE[opcode])
+            return
+
+        handler = CALLBACK_HANDLERS.get(opcode)
+        if handler is None or len(args) != handler.arity or self.state not in handler.states:
+            return
+        if opcode in HERO_DELTAS:
+            if (hero := self.heroes.get(args[0])) is not None:
+                counter = 1 if opcode.startswith("s") else 2
+                hero[counter] = max(0, hero[counter] + HERO_DELTAS[opcode])
+        elif opcode == callbacks.TIMER_TICK_ALL:
+            self.tick_timers()
+        elif opcode == callbacks.END_SCENE:
+            self.tick_timers()
+            self.timers = {i: timer for i, timer in self.timers.items() if timer[1] > 0}
+            for hero in self.heroes.values():
+                hero[1] = 0
+        elif opcode == callbacks.TIMER_MINUS:
+            if (timer := self.timers.get(args[0])) is not None and timer[1] > 0:
+                timer[1] -= 1
+        elif opcode == callbacks.TIMER_REMOVE:
+            self.timers.pop(args[0], None)
+        elif opcode == callbacks.ROLL and 1 <= args[0] <= MAX_ROLL_DICE:
+            self.transition(PotzState.root)
+
+    def get_counters(self) -> dict:
+        return {
+            **{("hero", name): (stress, harm) for name, stress, harm in self.heroes.values()},
+            **{("timer", name): (value,) for name, value in self.timers.values()},
+        }
+
+
+class TrafficGenerator:
+    """
+    Picks the next update of a chat from what its screen offers, weighted roughly like a game night
+    """
+
+    def __init__(self, seed: int):
+        self.random = random.Random(seed)
+        self.update_ids = iter(range(1, 1 << 62))
+
+    def next_update(self, chat_id: int, model: ChatModel) -> dict:
+        user_id = abs(chat_id) * PLAYERS_PER_CHAT + self.random.randrange(PLAYERS_PER_CHAT)
+        action = self.next_action(model)
+        if action.startswith("/"):
+            update = make_command_update(next(self.update_ids), chat_id, user_id, action)
+        else:
+            update = make_callback_update(next(self.update_ids), chat_id, user_id, KEYBOARD_MESSAGE_ID, action)
+        model.apply(update)
+        return update
+
+    def next_action(self, model: ChatModel) -> str:
+        choice = self.random.random
+        if model.state == PotzState.root:
+            if len(model.heroes) < 2 or (len(model.heroes) < MAX_HEROES and choice() < 0.05):
+                names = (f"hero{self.random.randrange(1000)}" for _ in range(self.random.randint(1, 3)))
+                return f"/add_hero {' '.join(names)}"
+            if len(model.timers) < MAX_TIMERS and choice() < 0.05:
+                return f"/add_timer clock{self.random.randrange(1000)} {self.random.randint(2, 8)}"
+            if choice() < 0.02:
+                return callbacks.END_SCENE
+            if choice() < 0.1:
+                return self.random.choice(("/roll", "/r 2d6+1", "/r 4d6kh3"))
+            screens = (PotzState.stress, PotzState.harm, PotzState.timer, PotzState.roll, PotzState.deck)
+            return self.random.choices(screens, weights=(4, 3, 1, 3, 1))[0].value
+
+        if model.state in (PotzState.stress, PotzState.harm) and model.heroes and choice() < 0.85:
+            hero_id = self.random.choice(list(model.heroes))
+            value = model.heroes[hero_id][1 if model.state == PotzState.stress else 2]
+            plus, minus = (callbacks.STRESS_PLUS, callbacks.STRESS_MINUS) if model.state == PotzState.stress else \
+                (callbacks.HARM_PLUS, callbacks.HARM_MINUS)
+            if choice() < 0.1:
+                step = callbacks.STRESS_STEP if model.state == PotzState.stress else callbacks.HARM_STEP
+                return encode_callback(step, hero_id)
+            return encode_callback(minus if value > 0 and choice() < 0.4 else plus, hero_id)
+        if model.state == PotzState.timer and choice() < 0.7:
+            running = [i for i, (_, value) in model.timers.items() if value > 0]
+            if running and choice() < 0.2:
+                return callbacks.TIMER_TICK_ALL
+            if running:
+                return encode_callback(callbacks.TIMER_MINUS, self.random.choice(running))
+        if model.state == PotzState.roll and choice() < 0.85:
+            if choice() < 0.1:
+                return callbacks.ODDS
+            return encode_callback(callbacks.ROLL, self.random.randint(1, MAX_ROLL_DICE))
+        if model.state == PotzState.deck and choice() < 0.6:
+            return encode_callback(callbacks.DECK_DRAW, 0)
+        return PotzState.root.value
+
+    def generate(self, chats: int, updates_per_chat: int) -> list[dict]:
+        chat_ids = [-i if i % GROUP_EVERY == 0 else i for i in range(1, chats + 1)]
+        models = {chat_id: ChatModel() for chat_id in chat_ids}
+        remaining = {chat_id: updates_per_chat for chat_id in chat_ids}
+        stream = []
+        # chats take turns at random, the order within a chat is kept
+        while remaining:
+            chat_id = self.random.choice(list(remaining))
+            stream.append(self.next_update(chat_id, models[chat_id]))
+            remaining[chat_id] -= 1
+            if not remaining[chat_id]:
+                del remaining[chat_id]
+        return stream
+
+
+def get_chat_id(update: dict):
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return (update.get("message") or {}).get("chat", {}).get("id")
+
+
+def sanitize(update: dict, pseudonyms: dict) -> dict:
+    """
+    Keeps only the fields the handlers read and replaces user and chat ids with stable pseudonyms
+    """
+    def pseudonym(kind: str, value: int) -> int:
+        key = (kind, value)
+        if key not in pseudonyms:
+            pseudonyms[key] = len(pseudonyms) + 1
+        return pseudonyms[key] if value > 0 else -pseudonyms[key]
+
+    def user(raw: dict) -> dict:
+        cleaned = {k: raw[k] for k in USER_FIELDS if k in raw}
+        cleaned["id"] = pseudonym("user", raw["id"])
+        cleaned["first_name"] = cleaned["username"] = f"user{cleaned['id']}"
+        return cleaned
+
+    def message(raw: dict) -> dict:
+        cleaned = {k: raw[k] for k in MESSAGE_FIELDS if k in raw}
+        cleaned["chat"] = {k: raw["chat"][k] for k in CHAT_FIELDS if k in raw["chat"]}
+        cleaned["chat"]["id"] = pseudonym("chat", raw["chat"]["id"])
+        if "from" in raw:
+            cleaned["from"] = user(raw["from"])
+        return cleaned
+
+    cleaned = {"update_id": update["update_id"]}
+    if "message" in update:
+        cleaned["message"] = message(update["message"])
+    elif "callback_query" in update:
+        query = update["callback_query"]
+        cleaned["callback_query"] = {k: query[k] for k in CALLBACK_FIELDS if k in query}
+        cleaned["callback_query"]["from"] = user(query["from"])
+        if "message" in query:
+            cleaned["callback_query"]["message"] = message(query["message"])
+    return cleaned
+
+
+def read_stream(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as stream:
+        return [json.loads(line) for line in stream if line.strip()]
+
+
+def write_stream(path: str, updates: list[dict]):
+    with open(path, "w", encoding="utf-8") as stream:
+        for update in updates:
+            stream.write(json.dumps(update) + "\n")
+
+
+def paced(updates: list[dict], rate: float):
+    """
+    Yields (scheduled start, update) at `rate` updates per second. Without a rate all updates are
+    yielded at once with no scheduled start, their latency starts when a worker picks them up.
+    """
+    started = time.perf_counter()
+    for i, update in enumerate(updates):
+        if not rate:
+            yield None, update
+            continue
+        scheduled = started + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield scheduled, update
+
+
+class PerThreadStateCache:
+    """
+    A separate state cache for every worker thread, like separate lambda instances have
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def get_cache(self) -> ChatStateCache:
+        if not hasattr(self.local, "cache"):
+            self.local.cache = ChatStateCache(botdata.STATE_CACHE_SIZE, botdata.STATE_CACHE_TTL)
+        return self.local.cache
+
+    def get(self, chat_id):
+        return self.get_cache().get(chat_id)
+
+    def put(self, chat_id, version: int, attributes: dict):
+        self.get_cache().put(chat_id, version, attributes)
+
+    def invalidate(self, chat_id):
+        self.get_cache().invalidate(chat_id)
+
+    def clear(self):
+        self.get_cache().clear()
+
+
+def run_lambda(updates: list[dict], request: FakeTelegramRequest, concurrency: int, rate: float) -> list[float]:
+    """
+    Every worker thread is a lambda instance with its own event loop, application and state cache,
+    all of them share the table like concurrent invocations do
+    """
+    local = threading.local()
+
+    def handle(scheduled, update: dict) -> float:
+        started = time.perf_counter() if scheduled is None else scheduled
+        if not hasattr(local, "application"):
+            local.loop = asyncio.new_event_loop()
+            local.application = newpotz.build_application(request=request, rate_limiter=NoRateLimiter())
+            local.loop.run_until_complete(local.application.initialize())
+        local.loop.run_until_complete(newpotz.process_update(local.application, update))
+        return time.perf_counter() - started
+
+    shared_cache = botdata.state_cache
+    botdata.state_cache = PerThreadStateCache()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [pool.submit(handle, scheduled, update) for scheduled, update in paced(updates, rate)]
+            return [future.result() for future in futures]
+    finally:
+        botdata.state_cache = shared_cache
+
+
+def run_server(updates: list[dict], request: FakeTelegramRequest, concurrency: int, rate: float) -> list[float]:
+    # imported here, server mode swaps the handlers to warm state for the whole process
+    from server import ChatOrderedUpdateProcessor # pylint: disable=import-outside-toplevel
+
+    async def run() -> list[float]:
+        sessions = ChatSessions(len(updates), SERVER_FLUSH_INTERVAL)
+        newpotz.use_chat_sessions(sessions)
+        processor = ChatOrderedUpdateProcessor(sessions, concurrency)
+        application = newpotz.build_application(processor, request=request, rate_limiter=NoRateLimiter())
+        await application.initialize()
+
+        # without a rate, `concurrency` clients each send their next update once the last one is answered
+        clients = asyncio.Semaphore(concurrency)
+
+        async def handle(scheduled, update: Update) -> float:
+            if scheduled is not None:
+                await processor.process_update(update, application.process_update(update))
+                return time.perf_counter() - scheduled
+            async with clients:
+                started = time.perf_counter()
+                await processor.process_update(update, application.process_update(update))
+                return time.perf_counter() - started
+
+        tasks = []
+        started = time.perf_counter()
+        for i, body in enumerate(updates):
+            scheduled = started + i / rate if rate else None
+            if scheduled is not None and (delay := scheduled - time.perf_counter()) > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(handle(scheduled, Update.de_json(body, application.bot))))
+        latencies = await asyncio.gather(*tasks)
+        # flushes the write behind
+        await application.shutdown()
+        return latencies
+
+    try:
+        return asyncio.run(run())
+    finally:
+        newpotz.use_chat_sessions(None)
+
+
+def count_lost_updates(updates: list[dict], table: InMemoryTable) -> int:
+    models = {}
+    for update in updates:
+        models.setdefault(get_chat_id(update), ChatModel()).apply(update)
+
+    lost = 0
+    for chat_id, model in models.items():
+        item = decode_item(table.items.get(str(chat_id), {}))
+        stored = {
+            **{("hero", h["name"]): (h["stress"], h["harm"]) for h in item.get("heroes", [])},
+            **{("timer", t["name"]): (t["value"],) for t in item.get("timers", [])},
+        }
+        for key, expected in model.get_counters().items():
+            actual = stored.get(key)
+            if actual is None:
+                lost += 1
+            else:
+                lost += sum(abs(a - b) for a, b in zip(expected, actual))
+    return lost
+
+
+def percentile(values: list[float], p: int) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def run_command(args):
+    if args.replay:
+        updates = read_stream(args.replay)
+    else:
+        updates = TrafficGenerator(args.seed).generate(args.chats, args.updates)
+    if args.record:
+        write_stream(args.record, updates)
+
+    metrics.set_enabled(False)
+    table = InMemoryTable(args.table_latency)
+    potzdb.set_potztable(table)
+    request = FakeTelegramRequest(args.telegram_latency)
+
+    started = time.perf_counter()
+    runner = run_server if args.mode == "server" else run_lambda
+    latencies = runner(updates, request, args.concurrency, args.rate)
+    elapsed = time.perf_counter() - started
+
+    chats = len({get_chat_id(update) for update in updates})
+    print(f"{len(updates)} updates over {chats} chats, mode {args.mode}, concurrency {args.concurrency}")
+    print(f"throughput: {len(updates) / elapsed:.0f} updates/s")
+    for p in (50, 95, 99):
+        print(f"p{p}: {percentile(latencies, p) * 1000:.1f} ms")
+    print(f"telegram calls per update: {sum(request.calls.values()) / len(updates):.2f} {dict(request.calls)}")
+    print(f"table calls per update: {sum(table.calls.values()) / len(updates):.2f} {dict(table.calls)}")
+    print(f"conditional write failures: {table.conditional_failures}")
+    print(f"lost updates: {count_lost_updates(updates, table)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="write a synthetic update stream")
+    sanitize_parser = commands.add_parser("sanitize", help="strip personal data from recorded update json")
+    run = commands.add_parser("run", help="drive an update stream through the handlers")
+    for command in (generate, run):
+        command.add_argument("--chats", type=int, default=1000)
+        command.add_argument("--updates", type=int, default=20, help="updates per chat")
+        command.add_argument("--seed", type=int, default=1)
+    generate.add_argument("--out", required=True)
+    sanitize_parser.add_argument("input", help="json lines of raw telegram updates")
+    sanitize_parser.add_argument("--out", required=True)
+    run.add_argument("--replay", help="json lines of updates to replay instead of generating them")
+    run.add_argument("--record", help="write the driven update stream here")
+    run.add_argument("--mode", choices=("lambda", "server"), default="lambda")
+    run.add_argument("--concurrency", type=int, default=32)
+    run.add_argument("--rate", type=float, default=0, help="updates per second, 0 for as fast as possible")
+    run.add_argument("--table-latency", type=float, default=0.005, help="seconds added to every table call")
+    run.add_argument("--telegram-latency", type=float, default=0.05, help="seconds added to every telegram call")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        write_stream(args.out, TrafficGenerator(args.seed).generate(args.chats, args.updates))
+    elif args.command == "sanitize":
+        pseudonyms = {}
+        write_stream(args.out, [sanitize(update, pseudonyms) for update in read_stream(args.input)])
+    else:
+        run_command(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""
+In-memory stand-ins for the potz_manager table and the telegram bot API, for benchmarks and load tests.
+
+InMemoryTable understands the subset of DynamoDB expressions potzdb.UpdateExpressionBuilder produces,
+FakeTelegramRequest answers every bot API method the handlers use. Both count calls and payload bytes
+and can add a fixed latency to every call.
+"""
+
+import asyncio
+import copy
+import itertools
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+from botocore.exceptions import ClientError
+from telegram.ext import BaseRateLimiter
+from telegram.request import BaseRequest
+
+CLAUSE_RE = re.compile(r"\b(SET|ADD|REMOVE)\s+")
+PATH_PART_RE = re.compile(r"\[(\d+)\]|\.?([#\w]+)")
+COMPARISON_RE = re.compile(r"^(?P<path>.+?)\s*(?P<op>=|<>|<=|>=|<|>)\s*(?P<value>:\w+)$")
+FUNCTION_RE = re.compile(r"^(?P<function>attribute_exists|attribute_not_exists)\((?P<path>.+)\)$")
+
+COMPARISONS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+MISSING = object()
+
+
+def payload_size(payload) -> int:
+    return len(json.dumps(payload, default=str))
+
+
+class InMemoryTable:
+    """
+    get_item/put_item/update_item of potzdb.PotzTable on a dict of items keyed by chat_id.
+    Every call is atomic, like a single item operation of DynamoDB, so it can be shared by threads.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.items = {}
+        self.calls = Counter()
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.conditional_failures = 0
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.read_bytes = 0
+        self.written_bytes = 0
+        self.conditional_failures = 0
+
+    def call(self, name: str):
+        # the latency is spent outside the lock, requests of different callers overlap like real ones
+        if self.latency:
+            time.sleep(self.latency)
+        self.calls[name] += 1
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **_kwargs) -> dict: # pylint: disable=invalid-name
+        self.call("get_item")
+        with self.lock:
+            return self.get_item_locked(Key, ProjectionExpression, ExpressionAttributeNames)
+
+    def get_item_locked(self, Key, ProjectionExpression, ExpressionAttributeNames) -> dict: # pylint: disable=invalid-name
+        item = self.items.get(Key["chat_id"])
+        if item is None:
+            return {}
+
+        if ProjectionExpression:
+            names = ExpressionAttributeNames or {}
+            item = {
+                name: item[name]
+                for name in (names.get(n.strip(), n.strip()) for n in ProjectionExpression.split(","))
+                if name in item
+            }
+        item = copy.deepcopy(item)
+        self.read_bytes += payload_size(item)
+        return {"Item": item}
+
+    def put_item(self, Item, **_kwargs) -> dict: # pylint: disable=invalid-name
+        self.call("put_item")
+        with self.lock:
+            self.written_bytes += payload_size(Item)
+            self.items[Item["chat_id"]] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None, # pylint: disable=invalid-name
+                    ConditionExpression=None, ReturnValues="NONE", **_kwargs) -> dict:
+        self.call("update_item")
+        with self.lock:
+            return self.update_item_locked(Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues,
+                                           ConditionExpression, ReturnValues)
+
+    def update_item_locked(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues, # pylint: disable=invalid-name
+                           ConditionExpression, ReturnValues) -> dict:
+        names = ExpressionAttributeNames or {}
+        values = ExpressionAttributeValues or {}
+        self.written_bytes += payload_size(values)
+
+        stored = self.items.get(Key["chat_id"])
+        item = copy.deepcopy(stored) if stored is not None else dict(Key)
+        if ConditionExpression and not all(
+            self.check(item, condition.strip(), names, values) for condition in ConditionExpression.split(" AND ")
+        ):
+            self.conditional_failures += 1
+            raise ClientError(
+                {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}},
+                "UpdateItem",
+            )
+
+        updated = set()
+        for action, clause in split_clauses(UpdateExpression):
+            for part in split_top_level(clause):
+                updated.add(self.apply(item, action, part.strip(), names, values))
+
+        self.items[Key["chat_id"]] = item
+        if ReturnValues == "ALL_NEW":
+            attributes = copy.deepcopy(item)
+        elif ReturnValues == "UPDATED_NEW":
+            attributes = {name: copy.deepcopy(item[name]) for name in updated if name in item}
+        else:
+            return {}
+        self.read_bytes += payload_size(attributes)
+        return {"Attributes": attributes}
+
+    def apply(self, item: dict, action: str, part: str, names: dict, values: dict) -> str:
+        """
+        Applies one action of a clause, returns the top level attribute it changed
+        """
+        if action == "REMOVE":
+            path = parse_path(part, names)
+            parent = resolve(item, path[:-1])
+            if isinstance(parent, dict):
+                parent.pop(path[-1], None)
+            return path[0]
+
+        if action == "ADD":
+            target, value = part.split()
+            path = parse_path(target, names)
+            current = resolve(item, path)
+            assign(item, path, values[value] + (0 if current is MISSING else current))
+            return path[0]
+
+        target, expression = (side.strip() for side in part.split("=", 1))
+        path = parse_path(target, names)
+        if "+" in expression or " - " in expression:
+            operand, op, value = expression.split()
+            current = resolve(item, parse_path(operand, names))
+            if current is MISSING:
+                raise ClientError({"Error": {"Code": "ValidationException", "Message": "Missing operand"}}, "UpdateItem")
+            assign(item, path, current + values[value] if op == "+" else current - values[value])
+        else:
+            assign(item, path, copy.deepcopy(values[expression]))
+        return path[0]
+
+    def check(self, item: dict, condition: str, names: dict, values: dict) -> bool:
+        if match := FUNCTION_RE.match(condition):
+            exists = resolve(item, parse_path(match.group("path"), names)) is not MISSING
+            return exists if match.group("function") == "attribute_exists" else not exists
+        if match := COMPARISON_RE.match(condition):
+            current = resolve(item, parse_path(match.group("path"), names))
+            if current is MISSING:
+                return False
+            return COMPARISONS[match.group("op")](current, values[match.group("value")])
+        raise ValueError(f"Unsupported condition {condition}")
+
+
+def split_clauses(expression: str) -> list[tuple[str, str]]:
+    matches = list(CLAUSE_RE.finditer(expression))
+    return [
+        (match.group(1), expression[match.end():matches[i + 1].start() if i + 1 < len(matches) else len(expression)])
+        for i, match in enumerate(matches)
+    ]
+
+
+def split_top_level(clause: str) -> list[str]:
+    # paths and placeholders never contain commas
+    return [part for part in clause.split(",") if part.strip()]
+
+
+def parse_path(path: str, names: dict) -> list:
+    parts = []
+    for index, name in PATH_PART_RE.findall(path.strip()):
+        parts.append(int(index) if index else names.get(name, name))
+    return parts
+
+
+def resolve(item, path: list):
+    current = item
+    for part in path:
+        try:
+            current = current[part]
+        except (KeyError, IndexError, TypeError):
+            return MISSING
+    return current
+
+
+def assign(item: dict, path: list, value):
+    parent = resolve(item, path[:-1])
+    if parent is MISSING:
+        raise ClientError({"Error": {"Code": "ValidationException", "Message": "Invalid document path"}}, "UpdateItem")
+    parent[path[-1]] = value
+
+
+class FakeTelegramRequest(BaseRequest):
+    """
+    Answers bot API calls locally with minimal valid results
+    """
+
+    def __init__(self, latency: float = 0.0, dice_values=None):
+        self.latency = latency
+        self.calls = Counter()
+        self.sent_bytes = 0
+        self.message_ids = itertools.count(1000)
+        self.dice_values = dice_values or itertools.cycle(range(1, 7))
+
+    def reset_counters(self):
+        self.calls.clear()
+        self.sent_bytes = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, # pylint: disable=unused-argument
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        parameters = {}
+        if request_data is not None:
+            self.sent_bytes += len(request_data.json_payload)
+            parameters = request_data.parameters
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self.result(endpoint, parameters)}).encode()
+
+    def result(self, endpoint: str, parameters: dict):
+        if endpoint == "getMe":
+            return make_user(1, "potzbot", is_bot=True)
+        if endpoint in ("answerCallbackQuery", "deleteMessage", "setWebhook", "deleteWebhook"):
+            return True
+        if endpoint == "getUpdates":
+            return []
+
+        chat_id = parameters.get("chat_id", 0)
+        message = make_message(parameters.get("message_id") or next(self.message_ids), chat_id)
+        if endpoint == "sendDice":
+            message["dice"] = {"emoji": "🎲", "value": next(self.dice_values)}
+        elif endpoint == "sendPhoto":
+            message["photo"] = [make_photo(message["message_id"])]
+        elif endpoint == "sendMediaGroup":
+            return [
+                dict(make_message(next(self.message_ids), chat_id), photo=[make_photo(i)])
+                for i, _ in enumerate(parameters.get("media", ()))
+            ]
+        elif "text" in parameters:
+            message["text"] = parameters["text"]
+        return message
+
+
+class NoRateLimiter(BaseRateLimiter):
+    """
+    Sends everything at once, the real limiter would pace a benchmark down to telegram's budgets
+    """
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        return await callback(*args, **kwargs)
+
+
+def make_user(user_id: int, username: str, is_bot: bool = False) -> dict:
+    return {"id": user_id, "is_bot": is_bot, "first_name": username, "username": username}
+
+
+def make_chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "private" if int(chat_id) > 0 else "group"}
+
+
+def make_message(message_id: int, chat_id, text: str = None, user_id: int = 1) -> dict:
+    message = {"message_id": message_id, "date": int(time.time()), "chat": make_chat(chat_id), "from": make_user(user_id, "potzbot", True)}
+    if text is not None:
+        message["text"] = text
+    return message
+
+
+def make_photo(index: int) -> dict:
+    return {"file_id": f"file{index}", "file_unique_id": f"unique{index}", "width": 1, "height": 1}
+
+
+def make_command_update(update_id: int, chat_id: int, user_id: int, text: str) -> dict:
+    message = make_message(update_id, chat_id, text)
+    message["from"] = make_user(user_id, f"user{user_id}")
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback_update(update_id: int, chat_id: int, user_id: int, message_id: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id, f"user{user_id}"),
+            "chat_instance": str(chat_id),
+            "message": make_message(message_id, chat_id),
+            "data": data,
+        },
+    }
+
+
+def make_event(update: dict) -> dict:
+    return {"body": json.dumps(update)}
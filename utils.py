@@ -16,16 +16,21 @@ def get_client_help_message() -> str:
     help_text = """
 What can this bot do?
 
-1. /add_hero <hero> [stress] [harm] - Add a hero to the list with optional starting stress and harm (default = 0)
-2. /add_timer <timer> <start_value> - Add timer with a starting value
+1. /add_hero <hero> [stress] [harm] ... - Add one or more heroes, each with optional starting stress and harm (default = 0)
+2. /add_timer <timer> <start_value> ... - Add one or more timers with their starting values
 3. /help - Show help message
 4. /privacy - Show the privacy disclaimer
 5. /remove_hero <hero> - Remove a hero from the list
 6. /roll - invoke Roll inline keyboard
+7. /r <expression> - Roll a dice expression, e.g. 2d20+5, 4d6kh3, 3d6! (exploding), 6d10>=8 (pool)
+8. /odds [pool size | expression] - Show crit/success/partial/fail odds of d6 pools, or the distribution of an expression
+9. /card <deck> [card] - Show an ability card, or the whole deck without a card name
 
 Using the inline keyboard you can:
-- Roll dice
-- Add or remove stress or harm from a hero
-- Advance or remove timers
+- Roll dice and check the odds of a pool
+- Add or remove stress or harm from a hero, one or three points at a time
+- Advance or remove timers, or tick all of them at once
+- End the scene: clear all stress, tick every timer and drop the expired ones
+- Draw, discard and reshuffle ability cards and show the hand
 """.strip()
     return help_text
\ No newline at end of file